@@ -29,8 +29,10 @@
 
 import click
 
+from msc_pygeoapi.process.weather.rdpa_cube import cli as rc
 from msc_pygeoapi.process.weather.rdpa_graph import cli as rg
 from msc_pygeoapi.process.weather.generate_vigilance import cli as gv
+from msc_pygeoapi.process.weather.pregenerate_vigilance import cli as pv
 
 
 @click.group()
@@ -40,6 +42,7 @@ def execute():
 
 execute.add_command(rg)
 execute.add_command(gv)
+execute.add_command(pv)
 
 
 @click.group()
@@ -48,3 +51,4 @@ def weather():
 
 
 weather.add_command(execute)
+weather.add_command(rc)
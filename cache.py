@@ -0,0 +1,271 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+from msc_pygeoapi.process.weather.metrics import count, OUTPUT_CACHE
+from msc_pygeoapi.process.weather.util import decode_output, encode_output
+
+LOGGER = logging.getLogger(__name__)
+
+# bytes of process outputs kept in memory
+CACHE_MEMORY_SIZE = int(os.environ.get('MSC_PYGEOAPI_CACHE_MEMORY_SIZE',
+                                       64 * 1024 * 1024))
+# directory of the disk tier of the output cache (not used when not set)
+CACHE_DIR = os.environ.get('MSC_PYGEOAPI_CACHE_DIR')
+# bytes of process outputs kept on disk
+CACHE_DISK_SIZE = int(os.environ.get('MSC_PYGEOAPI_CACHE_DISK_SIZE',
+                                     1024 * 1024 * 1024))
+
+# fraction of CACHE_DISK_SIZE the disk tier is evicted down to
+CACHE_LOW_WATER = 0.9
+
+CACHE_EXT = '.out'
+
+
+def cache_key(*parts):
+    """
+    compute the cache key of a process output
+
+    param parts : normalized inputs and source file identities, they
+                  need to be JSON serializable (or convertible with str)
+
+    return : key : sha256 hex digest
+    """
+
+    content = json.dumps(parts, sort_keys=True, separators=(',', ':'),
+                         default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class OutputCache(object):
+    """
+    two tier LRU cache of process outputs, bounded by size in bytes
+
+    outputs are kept as their raw bytes with a small JSON header (see
+    encode_output, nothing is unpickled), so every hit returns a new copy
+    of the output; the disk tier is shared by the processes using the
+    same directory, its entries are ordered by modification time, which
+    is updated on every hit, and they are evicted down to CACHE_LOW_WATER
+    of the size so eviction doesn't run on every write
+    """
+
+    def __init__(self, memory_size=CACHE_MEMORY_SIZE, directory=CACHE_DIR,
+                 disk_size=CACHE_DISK_SIZE):
+        """
+        Initialize object
+
+        param memory_size : bytes kept in memory (0 to disable)
+        param directory : directory of the disk tier (None to disable)
+        param disk_size : bytes kept on disk
+        """
+
+        self.memory_size = memory_size
+        self.directory = directory
+        self.disk_size = disk_size
+        self._entries = OrderedDict()
+        self._memory_used = 0
+        self._disk_used = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + CACHE_EXT)
+
+    def _remember(self, key, content, header):
+        if len(content) > self.memory_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._memory_used -= len(old[0])
+            self._entries[key] = (content, header)
+            self._memory_used += len(content)
+            while self._memory_used > self.memory_size:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_used -= len(evicted[0])
+
+    def _disk_entries(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(CACHE_EXT):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size,
+                                os.path.join(root, name)))
+        return entries
+
+    def _evict_disk(self):
+        # other processes write to the same directory, so the size is
+        # measured again before evicting
+        entries = self._disk_entries()
+        used = sum(entry[1] for entry in entries)
+        target = self.disk_size * CACHE_LOW_WATER
+        for _, size, path in sorted(entries):
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except OSError:
+                pass
+        return used
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fh:
+                header = json.loads(fh.readline().decode('utf-8'))
+                content = fh.read()
+            os.utime(path)
+        except (OSError, ValueError) as err:
+            if not isinstance(err, FileNotFoundError):
+                LOGGER.warning('invalid cache entry {}: {}'.format(key, err))
+            return None
+        return content, header
+
+    def _write(self, key, content, header):
+        path = self._path(key)
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'wb') as fh:
+                fh.write(json.dumps(header).encode('utf-8') + b'\n')
+                fh.write(content)
+            size = os.path.getsize(tmp)
+            try:
+                old = os.path.getsize(path)
+            except OSError:
+                old = 0
+            os.replace(tmp, path)
+        except OSError as err:
+            LOGGER.warning('unable to cache output: {}'.format(err))
+            return
+
+        with self._lock:
+            if self._disk_used is None:
+                self._disk_used = sum(entry[1] for entry in
+                                      self._disk_entries())
+            else:
+                self._disk_used += size - old
+            evict = self._disk_used > self.disk_size
+        if evict:
+            used = self._evict_disk()
+            with self._lock:
+                self._disk_used = used
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._entries:
+                return True
+        return (self.directory is not None and
+                os.path.exists(self._path(key)))
+
+    def get(self, key):
+        """
+        return the output cached for key
+
+        param key : cache key
+
+        return : output : cached output, None if not cached
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None and self.directory is not None:
+            entry = self._read(key)
+            if entry is not None:
+                self._remember(key, *entry)
+
+        if entry is None:
+            count(OUTPUT_CACHE, result='miss')
+            return None
+        count(OUTPUT_CACHE, result='hit')
+        try:
+            return decode_output(*entry)
+        except (KeyError, ValueError) as err:
+            LOGGER.warning('invalid cache entry {}: {}'.format(key, err))
+            self.pop(key)
+            return None
+
+    def set(self, key, output):
+        """
+        cache an output, evicting the least recently used entries
+
+        param key : cache key
+        param output : output to cache (None is not cached)
+        """
+
+        if output is None:
+            return
+
+        content, header = encode_output(output)
+        self._remember(key, content, header)
+        if self.directory is not None and len(content) <= self.disk_size:
+            self._write(key, content, header)
+
+    def pop(self, key):
+        """
+        remove an output from both tiers
+
+        param key : cache key
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._memory_used -= len(entry[0])
+
+        if self.directory is not None:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """remove every output kept in memory"""
+
+        with self._lock:
+            self._entries.clear()
+            self._memory_used = 0
+
+
+OUTPUTS = OutputCache()
@@ -28,29 +28,85 @@
 #
 # =================================================================
 import click
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from io import BytesIO
 import json
 import logging
+import os
+import time
+import uuid
 
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-from elasticsearch import Elasticsearch, exceptions
+from elasticsearch import exceptions
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
 import matplotlib.image as image
 from matplotlib.offsetbox import AnchoredText, OffsetImage, AnnotationBbox
 import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
 import numpy as np
-from osgeo import gdal, osr
+from osgeo import gdal
 from PIL import Image
 
+from msc_pygeoapi.process.weather.cache import cache_key, OUTPUTS
+from msc_pygeoapi.process.weather.jobs import (get_job_output,
+                                               JobQueueFull, run_job)
+from msc_pygeoapi.process.weather.metrics import BYTES_READ, count, timed
+from msc_pygeoapi.process.weather.render import (render,
+                                                 RenderError)
+from msc_pygeoapi.process.weather.util import (DATASETS, file_identity,
+                                               get_es, LRUCache,
+                                               search_pages)
+
 LOGGER = logging.getLogger(__name__)
 
 ES_INDEX = 'geomet-data-registry-tileindex'
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 CANADA_BBOX = '-140, 35, -44, 83'
 LAMBERT_BBOX = [-170, 15, -40, 90]
+# model run manifests (tile-index records of a model of a model run
+# forecast hour)
+MANIFEST_TTL = int(os.environ.get('MSC_PYGEOAPI_MANIFEST_TTL', 600))
+MANIFEST_NOT_FOUND_TTL = int(
+    os.environ.get('MSC_PYGEOAPI_MANIFEST_NOT_FOUND_TTL', 60))
+MANIFESTS = LRUCache(int(os.environ.get('MSC_PYGEOAPI_MANIFEST_CACHE_SIZE',
+                                        64)), MANIFEST_TTL)
+# thresholds (%) where the vigilance level of a band goes up by one, for
+# the bands of the lowest, middle and highest thresholds
+VIGILANCE_THRESHOLDS = ((40,), (1, 40), (1, 20, 60))
+# threads classifying the tiles of a request (1 to classify sequentially)
+VIGILANCE_WORKERS = int(os.environ.get('MSC_PYGEOAPI_VIGILANCE_WORKERS', 4))
+# approximate size (pixels) of the side of a tile
+VIGILANCE_TILE_SIZE = int(os.environ.get('MSC_PYGEOAPI_VIGILANCE_TILE_SIZE',
+                                         512))
+# rendered static map layers, by (projection, bbox, dpi)
+BASEMAPS = LRUCache(int(os.environ.get('MSC_PYGEOAPI_BASEMAP_CACHE_SIZE',
+                                       32)))
+PNG_DPI = 200
+# zlib compression level of the PNG outputs (0-9)
+PNG_COMPRESS_LEVEL = int(os.environ.get('MSC_PYGEOAPI_PNG_COMPRESS_LEVEL',
+                                        6))
+# GeoPNG colors of the vigilance levels 0 to 3
+GEOPNG_PALETTE = [255, 255, 255,
+                  246, 255, 0,
+                  255, 160, 0,
+                  255, 0, 0]
+# compression (DEFLATE or ZSTD) and tile size of the GeoTIFF outputs
+GEOTIFF_COMPRESS = os.environ.get('MSC_PYGEOAPI_GEOTIFF_COMPRESS', 'DEFLATE')
+GEOTIFF_BLOCK_SIZE = int(os.environ.get('MSC_PYGEOAPI_GEOTIFF_BLOCK_SIZE',
+                                        256))
+# size (pixels) of the Web Mercator tiles
+TILE_SIZE = 256
+# half size of the Web Mercator square (meters)
+MERCATOR_EXTENT = 20037508.342789244
+EARTH_RADIUS = 6378137.0
+# forecast hours of a forecast-hour range
+MAX_FORECAST_HOURS = int(os.environ.get('MSC_PYGEOAPI_VIGILANCE_MAX_HOURS',
+                                        100))
+# display time (ms) of the frames of the animated outputs
+FRAME_DURATION = int(os.environ.get('MSC_PYGEOAPI_FRAME_DURATION', 500))
 COLOR_MAP = [[1, 1, 1, 1],
              [1, 1, 0, 1],
              [1, 0.5, 0, 1],
@@ -111,7 +167,8 @@ PROCESS_METADATA = {
     }, {
         'id': 'bbox',
         'title': 'bounding box',
-        'description': '"x_min, y_min, x_max, y_max"',
+        'description': '"x_min, y_min, x_max, y_max" (default is ' +
+                       'Canada, not used in tile mode)',
         'input': {
             'literalDataDomain': {
                 'dataType': 'string',
@@ -120,12 +177,14 @@ PROCESS_METADATA = {
                 }
             }
         },
-        'minOccurs': 1,
+        'minOccurs': 0,
         'maxOccurs': 1
     }, {
         'id': 'format',
         'title': 'output format',
-        'description': 'PNG, GeoTiff or GeoPNG',
+        'description': 'PNG, GeoTiff or GeoPNG (PNG, GeoTiff or WebP ' +
+                       'for a forecast hour range), required unless a ' +
+                       'tile is given',
         'input': {
             'literalDataDomain': {
                 'dataType': 'string',
@@ -134,7 +193,85 @@ PROCESS_METADATA = {
                 }
             }
         },
-        'minOccurs': 1,
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'forecast-hour-end',
+        'title': 'last forecast hour',
+        'description': 'last forecast hour of a forecast hour range, ' +
+                       'the output is a GeoTiff with one band by ' +
+                       'forecast hour, or an animated PNG or WebP',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'timestamp',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'forecast-hour-step',
+        'title': 'forecast hour step',
+        'description': 'hours between the forecast hours of a range ' +
+                       '(default 24)',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'integer',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'tile',
+        'title': 'Web Mercator tile',
+        'description': '"z/x/y" of a 256px Web Mercator PNG tile, the ' +
+                       'bbox and format are ignored',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'mode',
+        'title': 'execution mode',
+        'description': 'sync (default) or async, async returns a job ' +
+                       'status right away and runs the process in the ' +
+                       'background',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'job-id',
+        'title': 'job id',
+        'description': 'id of an async job, returns the job output once ' +
+                       'it is done or the job status until then (the ' +
+                       'other inputs are ignored)',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
         'maxOccurs': 1
     }],
     'outputs': [{
@@ -145,6 +282,8 @@ PROCESS_METADATA = {
                 'mimeType': 'image/tiff'
             }, {
                 'mimeType': 'image/png',
+            }, {
+                'mimeType': 'image/webp',
             }, {
                 'mimeType': 'application/json',
             }]
@@ -246,10 +385,153 @@ def valid_layer(layers):
     return None, None, None
 
 
+def manifest_query(model, mr, fhs):
+    """
+    ES search of the tile-index records of a model for model run
+    forecast hours, sorted to be paged with search_pages
+
+    param model : model of the layers (GEPS or REPS)
+    param mr : model run
+    param fhs : forcast hour datetimes
+
+    return : s_object : search body
+    """
+
+    return {
+        '_source': ['properties.layer', 'properties.filepath',
+                    'properties.weather_variable',
+                    'properties.forecast_hour_datetime'],
+        'sort': [{'properties.forecast_hour_datetime': 'asc'},
+                 {'properties.layer.raw': 'asc'}],
+        'query': {
+            'bool': {
+                'filter': [
+                    {'terms': {'properties.forecast_hour_datetime':
+                               [fh.strftime(DATE_FORMAT) for fh in fhs]}},
+                    {'term': {'properties.reference_datetime':
+                              mr.strftime(DATE_FORMAT)}},
+                    {'prefix': {'properties.layer.raw': model + '.'}}
+                ]
+            }
+        }
+    }
+
+
+def manifest_key(model, mr, fh):
+    """
+    return : key : cache key of a model run forecast hour manifest
+    """
+
+    return model, mr.strftime(DATE_FORMAT), fh.strftime(DATE_FORMAT)
+
+
+def get_manifest(fh, mr, layers):
+    """
+    return the tile-index manifests of a model run forecast hour for the
+    models of the layers, all the records of a model are fetched with
+    one (paged) ES search and kept in cache
+
+    param fh : forcast hour datetime
+    param mr : model run
+    param layers : layers needed, a cached manifest missing one of them
+                   is fetched again after MANIFEST_NOT_FOUND_TTL seconds
+
+    return : records : dict of layer: (file path, weather variable)
+    """
+
+    records = {}
+    for model in sorted(set(layer.split('.')[0] for layer in layers)):
+        needed = [layer for layer in layers
+                  if layer.split('.')[0] == model]
+        key = manifest_key(model, mr, fh)
+        cached = MANIFESTS.get(key)
+
+        if cached is not None:
+            fetched, model_records = cached
+            if (all(layer in model_records for layer in needed) or
+                    time.monotonic() - fetched < MANIFEST_NOT_FOUND_TTL):
+                records.update(model_records)
+                continue
+
+        model_records = {}
+        try:
+            for hit in search_pages(get_es(), ES_INDEX,
+                                    manifest_query(model, mr, [fh])):
+                properties = hit['_source']['properties']
+                model_records[properties['layer']] = (
+                    properties['filepath'], properties['weather_variable'])
+
+        except exceptions.ElasticsearchException as error:
+            msg = 'ES search failed: {}' .format(error)
+            LOGGER.error(msg)
+            return None
+
+        records.update(cache_manifest(key, model_records))
+
+    return records
+
+
+def cache_manifest(key, records):
+    """
+    keep a model run forecast hour manifest in cache
+
+    param key : (model, model run, forecast hour) of the manifest
+    param records : dict of layer: (file path, weather variable)
+
+    return : records : the cached records
+    """
+
+    # empty manifests ("not found") are kept for a shorter time
+    ttl = MANIFEST_TTL if records else MANIFEST_NOT_FOUND_TTL
+    MANIFESTS.set(key, (time.monotonic(), records), ttl)
+    return records
+
+
+def prefetch_manifests(fhs, mr, model):
+    """
+    fetch the manifests of a model for several forecast hours of a model
+    run with one (paged) ES search, the manifests already cached are not
+    fetched
+
+    param fhs : forcast hour datetimes
+    param mr : model run
+    param model : model of the layers (GEPS or REPS)
+
+    return : ok : False if the ES search failed
+    """
+
+    manifests = {}
+    for fh in fhs:
+        if MANIFESTS.get(manifest_key(model, mr, fh)) is None:
+            manifests[fh.strftime(DATE_FORMAT)] = (fh, {})
+    if not manifests:
+        return True
+
+    s_object = manifest_query(model, mr,
+                              [fh for fh, _ in manifests.values()])
+
+    try:
+        for hit in search_pages(get_es(), ES_INDEX, s_object):
+            properties = hit['_source']['properties']
+            manifest = manifests.get(properties['forecast_hour_datetime'])
+            if manifest is not None:
+                manifest[1][properties['layer']] = (
+                    properties['filepath'], properties['weather_variable'])
+
+    except exceptions.ElasticsearchException as error:
+        msg = 'ES search failed: {}' .format(error)
+        LOGGER.error(msg)
+        return False
+
+    for fh, records in manifests.values():
+        cache_manifest(manifest_key(model, mr, fh), records)
+    return True
+
+
 def get_files(layers, fh, mr):
 
     """
-    ES search to find files names
+    find files names in the model run manifest
 
     param layers : arrays of three layers
     param fh : forcast hour datetime
@@ -257,49 +539,25 @@ def get_files(layers, fh, mr):
 
     return : files : arrays of threee file paths
     """
-    # TODO: use env variable for ES connection
 
-    es = Elasticsearch(['localhost:9200'])
+    records = get_manifest(fh, mr, layers)
+    if records is None:
+        return None, None
+
     files = []
     weather_variables = []
 
     for layer in layers:
-
-        s_object = {
-            'query': {
-                'bool': {
-                    'must': {
-                        'match': {'properties.layer.raw': layer}
-                    },
-                    'filter': [
-                        {'term': {'properties.forecast_hour_datetime':
-                                  fh.strftime(DATE_FORMAT)}},
-                        {'term': {'properties.reference_datetime':
-                                  mr.strftime(DATE_FORMAT)}}
-                    ]
-                }
-            }
-        }
-
         try:
-            res = es.search(index=ES_INDEX, body=s_object)
+            file_, weather_variable = records[layer]
+            files.append(file_)
+            weather_variables.append(weather_variable)
 
-            try:
-                files.append(res['hits']['hits'][0]
-                             ['_source']['properties']['filepath'])
-                weather_variables.append(res['hits']['hits'][0]
-                                         ['_source']['properties']
-                                         ['weather_variable'])
-
-            except IndexError as error:
-                msg = 'invalid input value: {}' .format(error)
-                LOGGER.error(msg)
-                return None, None
-
-        except exceptions.ElasticsearchException as error:
-            msg = 'ES search failed: {}' .format(error)
+        except KeyError as error:
+            msg = 'invalid input value: {} not found' .format(error)
             LOGGER.error(msg)
             return None, None
+
     return files, weather_variables
 
 
@@ -325,15 +583,14 @@ def get_bands(files):
     return paths, bands
 
 
-def read_croped_array(band, geotransform, bbox):
+def bbox_window(geotransform, bbox):
     """
-    create a array within the bbox from the grib band
+    find the raster window within the bbox
 
-    param band : grib band
     param geatransform : geographic info of the band
     param bbox : bounding box
 
-    return : array : cropped array
+    return : col, row, ncols, nrows : raster window
     """
 
     xinit = geotransform[0]
@@ -351,53 +608,157 @@ def read_croped_array(band, geotransform, bbox):
     row2 = int((p2[1] - yinit)/ysize)
     col2 = int((p2[0] - xinit)/xsize)
 
-    array = band.ReadAsArray(col1, row1, col2 - col1 + 1, row2 - row1 + 1)
-    return array
+    return col1, row1, col2 - col1 + 1, row2 - row1 + 1
+
+
+def snap_bbox(geotransform, bbox):
+    """
+    snap the bbox on the centers of the pixels of its raster window, so
+    every bbox within the same pixels gives the same bbox
+
+    param geotransform : geographic info of the band
+    param bbox : bounding box
+
+    return : bbox : snapped bounding box
+    """
+
+    col, row, ncols, nrows = bbox_window(geotransform, bbox)
+    x0, xres, _, y0, _, yres = geotransform
+
+    return [round(x0 + (col + 0.5) * xres, 10),
+            round(y0 + (row + nrows - 0.5) * yres, 10),
+            round(x0 + (col + ncols - 0.5) * xres, 10),
+            round(y0 + (row + 0.5) * yres, 10)]
+
 
+def classify(array, thresholds, out, level=None, mask=None):
+    """
+    classify a band by vigilance level, out keeps the max level
 
-def get_new_array(path, bands, bbox):
+    param array : band values
+    param thresholds : increasing thresholds where the vigilance level
+                       of the band goes up by one
+    param out : uint8 vigilance array, updated in place
+    param level : uint8 scratch array (same shape as array)
+    param mask : bool scratch array (same shape as array)
 
+    return : out : vigilance array
     """
-    combines 3 file into one array for vigilance
+
+    if level is None:
+        level = np.empty(array.shape, dtype=np.uint8)
+    if mask is None:
+        mask = np.empty(array.shape, dtype=bool)
+
+    level.fill(0)
+    for threshold in thresholds:
+        np.greater_equal(array, threshold, out=mask)
+        np.add(level, mask, out=level)
+
+    np.maximum(out, level, out=out)
+    return out
+
+
+def get_tiles(window, block_size, tile_size):
+    """
+    split a raster window into tiles aligned on the raster blocks
+
+    param window : raster window (col, row, ncols, nrows)
+    param block_size : raster block size (x, y)
+    param tile_size : approximate tile size in pixels
+
+    return : tiles : list of (col, row, ncols, nrows) windows
+    """
+
+    col, row, ncols, nrows = window
+    tile_x = max(block_size[0], tile_size // block_size[0] * block_size[0])
+    tile_y = max(block_size[1], tile_size // block_size[1] * block_size[1])
+
+    tiles = []
+    row_ = row
+    while row_ < row + nrows:
+        row_end = min((row_ // tile_y + 1) * tile_y, row + nrows)
+        col_ = col
+        while col_ < col + ncols:
+            col_end = min((col_ // tile_x + 1) * tile_x, col + ncols)
+            tiles.append((col_, row_, col_end - col_, row_end - row_))
+            col_ = col_end
+        row_ = row_end
+
+    return tiles
+
+
+def classify_tile(ds, bands, tile, window, max_array):
+    """
+    read and classify the 3 bands of a tile into its part of the
+    vigilance array
+
+    param ds : dataset
+    param bands : array of three grib band number
+    param tile : tile window (col, row, ncols, nrows)
+    param window : window of max_array (col, row, ncols, nrows)
+    param max_array : vigilance array, updated in place
+    """
+
+    col, row, ncols, nrows = tile
+    out = max_array[row - window[1]:row - window[1] + nrows,
+                    col - window[0]:col - window[0] + ncols]
+
+    array = np.empty((nrows, ncols), dtype=np.float32)
+    level = np.empty((nrows, ncols), dtype=np.uint8)
+    mask = np.empty((nrows, ncols), dtype=bool)
+
+    for band, thresholds in zip(bands, VIGILANCE_THRESHOLDS):
+        srcband = ds.GetRasterBand(band)
+        srcband.ReadAsArray(col, row, ncols, nrows, buf_obj=array)
+        count(BYTES_READ, array.nbytes)
+        classify(array, thresholds, out, level, mask)
+
+
+def get_new_array(path, bands, bbox, workers=None):
+
+    """
+    combines 3 file into one array for vigilance, large windows are
+    split in tiles classified on a thread pool
 
     param paths : arrays of three file paths
     param band : array of three grib band number
+    param workers : size of the thread pool (default VIGILANCE_WORKERS)
 
     return : max_array : the combined array for vigilance
     """
 
+    if workers is None:
+        workers = VIGILANCE_WORKERS
+
     try:
-        ds = gdal.Open(path)
+        with DATASETS.open(path) as ds:
+            geotransform = ds.GetGeoTransform()
+            window = bbox_window(geotransform, bbox)
+            max_array = np.zeros((window[3], window[2]), dtype=np.uint8)
+
+            block_size = ds.GetRasterBand(bands[0]).GetBlockSize()
+            tiles = get_tiles(window, block_size, VIGILANCE_TILE_SIZE)
+
+            if workers <= 1 or len(tiles) == 1:
+                for tile in tiles:
+                    classify_tile(ds, bands, tile, window, max_array)
+                return max_array
+
+        # datasets can't be shared between threads, each tile checks out
+        # its own handle (the tiles write to distinct parts of max_array)
+        def run(tile):
+            with DATASETS.open(path) as ds:
+                classify_tile(ds, bands, tile, window, max_array)
+
+        with ThreadPoolExecutor(max_workers=min(workers, len(tiles))) as ex:
+            list(ex.map(run, tiles))
+
     except RuntimeError as err:
-        msg = 'Cannot open file: {}, assigning NA'.format(err)
+        msg = 'Cannot open file: {}'.format(err)
         LOGGER.error(msg)
+        return None
 
-    geotransform = ds.GetGeoTransform()
-    band = bands[0]
-    srcband = ds.GetRasterBand(band)
-    array1 = read_croped_array(srcband, geotransform, bbox)
-    array1[array1 < 40] = 0
-    array1[(array1 >= 40) & (array1 < 60)] = 1
-    array1[array1 >= 60] = 1
-
-    band = bands[1]
-    srcband = ds.GetRasterBand(band)
-    array2 = read_croped_array(srcband, geotransform, bbox)
-    array2[(array2 >= 1) & (array2 < 20)] = 1
-    array2[(array2 >= 20) & (array2 < 40)] = 1
-    array2[(array2 >= 40) & (array2 < 60)] = 2
-    array2[array2 >= 60] = 2
-
-    band = bands[2]
-    srcband = ds.GetRasterBand(band)
-    array3 = read_croped_array(srcband, geotransform, bbox)
-    array3[(array3 >= 1) & (array3 < 20)] = 1
-    array3[(array3 >= 20) & (array3 < 40)] = 2
-    array3[(array3 >= 40) & (array3 < 60)] = 2
-    array3[array3 >= 60] = 3
-
-    max_array = np.maximum(array1, array2)
-    max_array = np.maximum(max_array, array3)
     return max_array
 
 
@@ -445,9 +806,97 @@ def get_data_text(variable, tresholds, mr, model, fh):
     return textstr
 
 
+def get_static_layer(project, bbox, dpi):
+    """
+    render the static layers of a map (coastlines, borders, provinces,
+    logo and legend) once per projection, bbox and dpi, they are kept as
+    a raster of the map area
+
+    param project : map projection
+    param bbox : geo exetent of the map
+    param dpi : resolution of the map
+
+    return : layer : RGBA (uint8) array of the static layers
+    """
+
+    key = (project.proj4_init, tuple(bbox), dpi)
+    layer = BASEMAPS.get(key)
+    if layer is not None:
+        return layer
+
+    fig = Figure(dpi=dpi)
+    FigureCanvasAgg(fig)
+    try:
+        fig.patch.set_alpha(0)
+        ax = fig.add_subplot(projection=project)
+        ax.set_extent(bbox_extent(bbox), crs=ccrs.PlateCarree())
+        ax.patch.set_visible(False)
+        ax.spines['geo'].set_visible(False)
+
+        # adding the basemap
+        ax.coastlines(linewidth=0.35)
+        ax.add_feature(cfeature.BORDERS, linestyle='-',
+                       edgecolor='black',
+                       linewidth=0.35)
+        state = cfeature.NaturalEarthFeature(
+            category='cultural', name='admin_1_states_provinces_lines',
+            scale='50m', facecolor='none')
+        ax.add_feature(state, edgecolor='black', linewidth=0.35)
+
+        # adding the logo
+        im = image.imread('msc_pygeoapi/process/weather/logo.png')
+        imagebox = OffsetImage(im, zoom=0.5, filternorm=True, filterrad=4.0,
+                               resample=False, dpi_cor=False)
+        ab = AnnotationBbox(imagebox, (0.003, 0.996), xycoords=ax.transAxes,
+                            frameon=True, box_alignment=(0, 1), pad=0.1)
+        ab.patch.set(linewidth=0.35)
+        ab.set_zorder(10)
+        ax.add_artist(ab)
+
+        # adding the legend
+        str1 = 'Be aware / Soyez Attentif'
+        str2 = 'Be prepared / Soyez très vigilant'
+        str3 = 'Be extra cautious / Vigilance absolue'
+        y_patch = mpatches.Patch(color='yellow', label=str1)
+        o_patch = mpatches.Patch(color='orange', label=str2)
+        r_patch = mpatches.Patch(color='red', label=str3)
+        leg = ax.legend(handles=[y_patch, o_patch, r_patch],
+                        loc='lower left', bbox_to_anchor=(0, 0),
+                        fancybox=False, fontsize=4, framealpha=1,
+                        borderaxespad=0.05, edgecolor='black',
+                        borderpad=0.5)
+        leg_frame = leg.get_frame()
+        leg_frame.set(linewidth=0.35)
+
+        # keeping the pixels of the map area
+        fig.canvas.draw()
+        rgba = np.asarray(fig.canvas.buffer_rgba())
+        x0, y0, x1, y1 = np.round(ax.get_window_extent().extents).astype(int)
+        height = rgba.shape[0]
+        layer = rgba[height - y1:height - y0, x0:x1].copy()
+    finally:
+        fig.clear()
+
+    BASEMAPS.set(key, layer)
+    return layer
+
+
+def bbox_extent(bbox):
+    """
+    convert a bbox to a cartopy extent
+
+    param bbox : bounding box (x_min, y_min, x_max, y_max)
+
+    return : extent : (x_min, x_max, y_min, y_max)
+    """
+
+    return [bbox[0], bbox[2], bbox[1], bbox[3]]
+
+
 def add_basemap(data, bbox, textstr):
     """
-    add the basemap spacified by the bbox to the vigilance data
+    add the basemap spacified by the bbox to the vigilance data, the
+    static layers are rendered once and composited over the data
 
     param data : vigilance data
     param bbox : geo exetent of the data
@@ -456,101 +905,122 @@ def add_basemap(data, bbox, textstr):
     with the bsaemap
     """
 
-    # adding vigilance data
     project = find_best_projection(bbox)
-    ny, nx = data.shape
-    lons = np.linspace(bbox[0], bbox[2], nx)
-    lats = np.linspace(bbox[3], bbox[1], ny)
-    lons, lats = np.meshgrid(lons, lats)
-    ax = plt.axes(projection=project)
-
-    max_ = int(np.amax(data)) + 1
-    colors = ListedColormap(COLOR_MAP[0:max_])
-    plt.contourf(lons, lats, data, max_, transform=ccrs.PlateCarree(),
-                 cmap=colors)
-
-    # adding the basemap
-    ax.coastlines(linewidth=0.35)
-    ax.add_feature(cfeature.BORDERS, linestyle='-',
-                   edgecolor='black',
-                   linewidth=0.35)
-    state = cfeature.NaturalEarthFeature(category='cultural',
-                                         name='admin_1_states_provinces_lines',
-                                         scale='50m', facecolor='none')
-    ax.add_feature(state, edgecolor='black', linewidth=0.35)
-
-    # adding vigilance metadata
-    text_box = AnchoredText(textstr, frameon=True, loc=4, pad=0.5,
-                            borderpad=0.05, prop={'size': 5})
-    plt.setp(text_box.patch, facecolor='white', alpha=1, linewidth=0.35)
-    ax.add_artist(text_box)
-
-    # adding the logo
-    im = image.imread('msc_pygeoapi/process/weather/logo.png')
-    imagebox = OffsetImage(im, zoom=0.5, filternorm=True, filterrad=4.0,
-                           resample=False, dpi_cor=False)
-    ab = AnnotationBbox(imagebox, (0.003, 0.996), xycoords=ax.transAxes,
-                        frameon=True, box_alignment=(0, 1), pad=0.1)
-    plt.setp(ab.patch, linewidth=0.35)
-    ab.set_zorder(10)
-    ax.add_artist(ab)
-
-    # adding the legend
-    str1 = 'Be aware / Soyez Attentif'
-    str2 = 'Be prepared / Soyez très vigilant'
-    str3 = 'Be extra cautious / Vigilance absolue'
-    y_patch = mpatches.Patch(color='yellow', label=str1)
-    o_patch = mpatches.Patch(color='orange', label=str2)
-    r_patch = mpatches.Patch(color='red', label=str3)
-    leg = plt.legend(handles=[y_patch, o_patch, r_patch], loc='lower left',
-                     bbox_to_anchor=(0, 0), fancybox=False, fontsize=4,
-                     framealpha=1, borderaxespad=0.05, edgecolor='black',
-                     borderpad=0.5)
-    leg_frame = leg.get_frame()
-    plt.setp(leg_frame, linewidth=0.35)
+    layer = get_static_layer(project, bbox, PNG_DPI)
+
+    # the figure is not managed by pyplot, so maps can be rendered in
+    # threads without sharing a current figure
+    fig = Figure(dpi=PNG_DPI)
+    FigureCanvasAgg(fig)
+    try:
+        # adding vigilance data
+        ny, nx = data.shape
+        lons = np.linspace(bbox[0], bbox[2], nx)
+        lats = np.linspace(bbox[3], bbox[1], ny)
+        lons, lats = np.meshgrid(lons, lats)
+        ax = fig.add_subplot(projection=project)
+
+        max_ = int(np.amax(data)) + 1
+        colors = ListedColormap(COLOR_MAP[0:max_])
+        ax.contourf(lons, lats, data, max_, transform=ccrs.PlateCarree(),
+                    cmap=colors)
+        ax.set_extent(bbox_extent(bbox), crs=ccrs.PlateCarree())
+
+        # adding the static layers over the map area
+        ax.imshow(layer, origin='upper', extent=ax.get_extent(),
+                  transform=project, interpolation='nearest', zorder=5)
+        ax.set_extent(bbox_extent(bbox), crs=ccrs.PlateCarree())
+
+        # adding vigilance metadata
+        text_box = AnchoredText(textstr, frameon=True, loc=4, pad=0.5,
+                                borderpad=0.05, prop={'size': 5})
+        text_box.patch.set(facecolor='white', alpha=1, linewidth=0.35)
+        text_box.set_zorder(10)
+        ax.add_artist(text_box)
+
+        buffer = BytesIO()
+        fig.savefig(buffer, bbox_inches='tight', dpi=PNG_DPI, format='png')
+    finally:
+        fig.clear()
 
-    buffer = BytesIO()
-    plt.savefig(buffer, bbox_inches='tight', dpi=200, format='png')
     return buffer
 
 
-def get_geotiff(data, bbox, path):
+def vigilance_statistics(data):
     """
-    transform the vigilance numpy array into a Geotiff file
+    compute the statistics of a vigilance array in a single pass
 
-    param data : vigilance array
+    param data : vigilance array (levels 0 to 3)
+
+    return : min, max, mean, std : statistics of the array
+    """
+
+    counts = np.bincount(data.ravel(), minlength=4).astype(np.float64)
+    levels = np.arange(counts.size, dtype=np.float64)
+    present = np.flatnonzero(counts)
+    total = counts.sum()
+
+    mean = np.dot(levels, counts) / total
+    variance = np.dot(levels * levels, counts) / total - mean * mean
+
+    return (float(present[0]), float(present[-1]), float(mean),
+            float(np.sqrt(max(variance, 0))))
+
+
+def get_geotiff(data, bbox, path, descriptions=None):
+    """
+    transform the vigilance numpy array into a Cloud-Optimized Geotiff file
+
+    param data : vigilance array, or (bands, rows, cols) array of
+                 several vigilance arrays
     param bbox : bounding box
+    param path : path of one of the source files (for georeferencing)
+    param descriptions : descriptions of the bands (optional)
 
     return : buffer : buffer of the geoTiff bytes
     """
 
-    driver = gdal.GetDriverByName('GTiff')
-    ds = gdal.Open(path)
-    ysize, xsize = data.shape
+    info = DATASETS.info(path)
+    gt = info.geotransform
+    col, row = bbox_window(gt, bbox)[:2]
+    data = data.reshape((-1,) + data.shape[-2:])
+    nbands, ysize, xsize = data.shape
+
+    # the array starts on the first pixel of the bbox window
+    gt = (gt[0] + col * gt[1] + row * gt[2], gt[1], gt[2],
+          gt[3] + col * gt[4] + row * gt[5], gt[4], gt[5])
 
-    driver.Create('/vsimem/vigi', xsize, ysize, 1, gdal.GDT_Byte)
-    ds_ = gdal.Open('/vsimem/vigi', gdal.GA_Update)
-    srs = osr.SpatialReference()
-    wkt = ds.GetProjection()
-    srs.ImportFromWkt(wkt)
-    ds_.SetProjection(srs.ExportToWkt())
-    gt = ds.GetGeoTransform()
-    gt = (bbox[0], gt[1], gt[2], bbox[3], gt[4], gt[5])
+    driver = gdal.GetDriverByName('MEM')
+    ds_ = driver.Create('', xsize, ysize, nbands, gdal.GDT_Byte)
+    ds_.SetProjection(info.projection)
     ds_.SetGeoTransform(gt)
 
-    outband = ds_.GetRasterBand(1)
-    outband.SetStatistics(np.min(data), np.max(data),
-                          np.average(data), np.std(data))
-    outband.WriteArray(data)
+    for index in range(nbands):
+        outband = ds_.GetRasterBand(index + 1)
+        outband.WriteArray(data[index])
+        outband.SetStatistics(*vigilance_statistics(data[index]))
+        if descriptions is not None:
+            outband.SetDescription(descriptions[index])
 
-    driver.CreateCopy('/vsimem/vigi', ds_)
+    filename = '/vsimem/vigi_{}.tif'.format(uuid.uuid4().hex)
+    try:
+        cog = gdal.GetDriverByName('COG').CreateCopy(filename, ds_, options=[
+            'COMPRESS={}'.format(GEOTIFF_COMPRESS),
+            'BLOCKSIZE={}'.format(GEOTIFF_BLOCK_SIZE),
+            'OVERVIEWS=AUTO',
+            'RESAMPLING=NEAREST'
+        ])
+        if cog is None:
+            LOGGER.error('unable to write geotiff: {}'.format(
+                gdal.GetLastErrorMsg()))
+            return None
+        cog = None
+
+        buffer = BytesIO(gdal.VSIGetMemFileBuffer_unsafe(filename))
+    finally:
+        ds_ = None
+        gdal.Unlink(filename)
 
-    file_buffer = gdal.VSIGetMemFileBuffer_unsafe('/vsimem/vigi')
-    buffer = BytesIO()
-    buffer.write(file_buffer)
-    buffer.seek(0)
-    gdal.Unlink('/vsimem/vigi')
-    ds_ = None
     return buffer
 
 
@@ -585,15 +1055,11 @@ def get_geopng(data, bbox):
     f.close()
     '''
 
-    color = np.zeros((data.shape[0], data.shape[1], 3))
-    color[data == 0] = [255, 255, 255]
-    color[data == 1] = [246, 255, 0]
-    color[data == 2] = [255, 160, 0]
-    color[data == 3] = [255, 0, 0]
-
-    im = Image.fromarray(np.uint8(color), 'RGB')
+    # palette image written directly from the vigilance levels
+    im = Image.fromarray(np.ascontiguousarray(data, dtype=np.uint8))
+    im.putpalette(GEOPNG_PALETTE)
     b = BytesIO()
-    im.save(b, format='PNG')
+    im.save(b, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
 
     output = {
         'pgw': pgw,
@@ -602,6 +1068,257 @@ def get_geopng(data, bbox):
     return output
 
 
+def parse_tile(tile):
+    """
+    validate and convert (string to int) the z/x/y tile
+
+    param tile : tile as z/x/y
+
+    return : z, x, y : tile indexes, None if the tile is invalid
+    """
+
+    try:
+        z, x, y = [int(item) for item in tile.split('/')]
+    except (AttributeError, ValueError):
+        return None
+
+    if z < 0 or z > 24 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return None
+    return z, x, y
+
+
+def tile_bounds(z, x, y):
+    """
+    find the Web Mercator bounds of a tile
+
+    param z : zoom level
+    param x : tile column
+    param y : tile row
+
+    return : bounds : minx, miny, maxx, maxy in meters
+    """
+
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    minx = -MERCATOR_EXTENT + x * size
+    maxy = MERCATOR_EXTENT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def mercator_to_lonlat(mx, my):
+    """
+    convert Web Mercator coordinates to longitude/latitude
+
+    param mx : x coordinates (meters)
+    param my : y coordinates (meters)
+
+    return : lon, lat : coordinates in degrees
+    """
+
+    lon = np.degrees(np.asarray(mx) / EARTH_RADIUS)
+    lat = np.degrees(np.arctan(np.sinh(np.asarray(my) / EARTH_RADIUS)))
+    return lon, lat
+
+
+def tile_bbox(info, bounds):
+    """
+    find the bbox of the raster needed by a tile
+
+    param info : DatasetInfo of the source raster
+    param bounds : Web Mercator bounds of the tile
+
+    return : bbox : bounding box within the raster, None if the tile
+                    is outside of the raster
+    """
+
+    x0, xres, _, y0, _, yres = info.geotransform
+    (west, east), (south, north) = mercator_to_lonlat(bounds[0::2],
+                                                      bounds[1::2])
+
+    # kept half a pixel inside the raster so the window stays in it
+    bbox = [max(west, x0 + xres / 2),
+            max(south, y0 + (info.ysize - 0.5) * yres),
+            min(east, x0 + (info.xsize - 0.5) * xres),
+            min(north, y0 + yres / 2)]
+
+    if bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+        return None
+    return bbox
+
+
+def resample_tile(data, geotransform, bounds, size=TILE_SIZE):
+    """
+    resample a vigilance window on a Web Mercator tile (nearest
+    neighbour), pixels outside of the window are set to 0
+
+    param data : vigilance array of the window
+    param geotransform : geotransform of the window
+    param bounds : Web Mercator bounds of the tile
+    param size : size of the tile in pixels
+
+    return : tile : uint8 array of size x size
+    """
+
+    step = (bounds[2] - bounds[0]) / size
+    centers = (np.arange(size) + 0.5) * step
+    lon, lat = mercator_to_lonlat(bounds[0] + centers, bounds[3] - centers)
+
+    cols = np.floor((lon - geotransform[0]) / geotransform[1]).astype(int)
+    rows = np.floor((lat - geotransform[3]) / geotransform[5]).astype(int)
+    valid_cols = (cols >= 0) & (cols < data.shape[1])
+    valid_rows = (rows >= 0) & (rows < data.shape[0])
+
+    tile = np.zeros((size, size), dtype=np.uint8)
+    tile[np.ix_(valid_rows, valid_cols)] = data[
+        np.ix_(rows[valid_rows], cols[valid_cols])]
+    return tile
+
+
+def tile_key(layers, bands, fh, mr, tile, path):
+    """
+    compute the output cache key of a vigilance tile
+
+    param layers : 3 layers of the vigilance
+    param bands : sorted grib band numbers
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param tile : tile indexes as (z, x, y)
+    param path : source file path
+
+    return : key : cache key
+    """
+
+    return cache_key('vigilance-tile', layers, bands,
+                     fh.strftime(DATE_FORMAT), mr.strftime(DATE_FORMAT),
+                     list(tile), file_identity(path))
+
+
+@timed('vigilance-tile', 'total')
+def get_tile(layers, fh, mr, tile):
+    """
+    generate a 256px Web Mercator vigilance tile, from the window of
+    the raster under the tile only
+
+    param layers : 3 layer of the 3 different thresholds
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param tile : tile as z/x/y
+
+    return : buffer : buffer of the tile PNG bytes
+    """
+
+    tile = parse_tile(tile)
+    if tile is None:
+        LOGGER.error('Invalid tile')
+        return None
+    if len(layers) != 3:
+        LOGGER.error('Invalid number of layers')
+        return None
+
+    sufix, model, tresholds = valid_layer(layers)
+    if sufix is None:
+        return None
+
+    with timed('vigilance-tile', 'lookup'):
+        files, variables = get_files(layers, fh, mr)
+    if files is None:
+        return None
+
+    path, bands = get_bands(files)
+    bands.sort(reverse=(sufix == 'ERLE'))
+
+    key = tile_key(layers, bands, fh, mr, tile, path)
+    output = OUTPUTS.get(key)
+    if output is not None:
+        return BytesIO(output)
+
+    try:
+        info = DATASETS.info(path)
+    except RuntimeError as err:
+        LOGGER.error('unable to open {}: {}'.format(path, err))
+        return None
+
+    bounds = tile_bounds(*tile)
+    bbox = tile_bbox(info, bounds)
+    if bbox is None:
+        data = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+    else:
+        with timed('vigilance-tile', 'read_classify'):
+            vigi_data = get_new_array(path, bands, bbox)
+        if vigi_data is None:
+            return None
+
+        col, row = bbox_window(info.geotransform, bbox)[:2]
+        x0, xres, _, y0, _, yres = info.geotransform
+        data = resample_tile(vigi_data, (x0 + col * xres, xres, 0,
+                                         y0 + row * yres, 0, yres), bounds)
+
+    with timed('vigilance-tile', 'encode'):
+        im = Image.fromarray(data)
+        im.putpalette(GEOPNG_PALETTE)
+        buffer = BytesIO()
+        im.save(buffer, format='PNG', transparency=0,
+                compress_level=PNG_COMPRESS_LEVEL)
+
+    OUTPUTS.set(key, buffer.getvalue())
+
+    buffer.seek(0)
+    return buffer
+
+
+def vigilance_key(layers, bands, fh, mr, bbox, format_, path):
+    """
+    compute the output cache key of a vigilance product
+
+    param layers : 3 layers of the vigilance
+    param bands : sorted grib band numbers
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param bbox : snapped bounding box
+    param format_ : output format
+    param path : source file path
+
+    return : key : cache key
+    """
+
+    return cache_key('generate-vigilance', layers, bands,
+                     fh.strftime(DATE_FORMAT), mr.strftime(DATE_FORMAT),
+                     bbox, format_, file_identity(path))
+
+
+def get_output(vigi_data, bbox, path, format_, variable, tresholds, mr,
+               model, fh):
+    """
+    write the vigilance array in the output format
+
+    param vigi_data : vigilance array
+    param bbox : bounding box
+    param path : source file path (for georeferencing)
+    param format_ : output format
+    param variable : weather variable of the layers
+    param tresholds : thresholds of the layers
+    param mr : model run
+    param model : GEPS or REPS
+    param fh : forcast hour
+
+    return : output : buffer of the file in bytes (GeoPNG dict)
+    """
+
+    if format_ == 'png':
+        textstr = get_data_text(variable, tresholds, mr, model, fh)
+        with timed('generate-vigilance', 'render'):
+            return render(add_basemap, vigi_data, bbox, textstr)
+    elif format_ == 'geotiff':
+        with timed('generate-vigilance', 'encode'):
+            return get_geotiff(vigi_data, bbox, path)
+    elif format_ == 'geopng':
+        with timed('generate-vigilance', 'encode'):
+            return get_geopng(vigi_data, bbox)
+
+    LOGGER.error('invalid format')
+    return None
+
+
+@timed('generate-vigilance', 'total')
 def generate_vigilance(layers, fh, mr, bbox, format_):
     """
     generate a vigilance file (with specified format)
@@ -625,7 +1342,8 @@ def generate_vigilance(layers, fh, mr, bbox, format_):
             if sufix is None:
                 return None
 
-            files, variables = get_files(layers, fh, mr)
+            with timed('generate-vigilance', 'lookup'):
+                files, variables = get_files(layers, fh, mr)
             if files is None:
                 return None
 
@@ -637,20 +1355,28 @@ def generate_vigilance(layers, fh, mr, bbox, format_):
                 if sufix == 'ERLE':
                     bands.sort(reverse=True)
 
-                vigi_data = get_new_array(path, bands, bbox)
-                if format_ == 'png':
-                    textstr = get_data_text(variables[0], tresholds, mr,
-                                            model, fh)
-                    png_buffer = add_basemap(vigi_data, bbox, textstr)
-                    return png_buffer
-                elif format_ == 'geotiff':
-                    tiff_buffer = get_geotiff(vigi_data, bbox, path)
-                    return tiff_buffer
-                elif format_ == 'geopng':
-                    geopng_buffer = get_geopng(vigi_data, bbox)
-                    return geopng_buffer
-                else:
-                    LOGGER.error('invalid format')
+                # near-identical bbox share the same grid window, so the
+                # same output; it is looked up before reading any data
+                try:
+                    bbox = snap_bbox(DATASETS.info(path).geotransform, bbox)
+                except RuntimeError as err:
+                    LOGGER.error('unable to open {}: {}'.format(path, err))
+                    return None
+                key = vigilance_key(layers, bands, fh, mr, bbox, format_,
+                                    path)
+                output = OUTPUTS.get(key)
+                if output is not None:
+                    return output
+
+                with timed('generate-vigilance', 'read_classify'):
+                    vigi_data = get_new_array(path, bands, bbox)
+                if vigi_data is None:
+                    return None
+
+                output = get_output(vigi_data, bbox, path, format_,
+                                    variables[0], tresholds, mr, model, fh)
+                OUTPUTS.set(key, output)
+                return output
             else:
                 LOGGER.error('invalid layer')
         else:
@@ -660,6 +1386,200 @@ def generate_vigilance(layers, fh, mr, bbox, format_):
     return None
 
 
+def forecast_hours(fh, fh_end, fh_step):
+    """
+    list the forecast hours of a range
+
+    param fh : first forcast hour datetime
+    param fh_end : last forcast hour datetime
+    param fh_step : hours between the forecast hours
+
+    return : fhs : forcast hour datetimes, None if the range is invalid
+    """
+
+    if fh_step <= 0 or fh_end < fh:
+        return None
+
+    nhours = int((fh_end - fh).total_seconds() // (fh_step * 3600)) + 1
+    if nhours > MAX_FORECAST_HOURS:
+        return None
+    return [fh + timedelta(hours=fh_step * i) for i in range(nhours)]
+
+
+def get_animation(frames, format_):
+    """
+    combine rendered maps into an animated PNG or WebP
+
+    param frames : buffers of the PNG maps
+    param format_ : png or webp
+
+    return : buffer : buffer of the animation bytes
+    """
+
+    images = [Image.open(frame) for frame in frames]
+    options = {
+        'save_all': True,
+        'append_images': images[1:],
+        'duration': FRAME_DURATION,
+        'loop': 0
+    }
+    if format_ == 'webp':
+        options.update(format='WEBP', quality=90)
+    else:
+        options.update(format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+
+    buffer = BytesIO()
+    images[0].save(buffer, **options)
+    buffer.seek(0)
+    return buffer
+
+
+@timed('generate-vigilance-range', 'total')
+def generate_vigilance_range(layers, fh, fh_end, fh_step, mr, bbox,
+                             format_):
+    """
+    generate a vigilance file for a range of forecast hours, a multi-band
+    geotiff (one band by forecast hour) or an animated PNG or WebP
+
+    the manifests of every forecast hour are fetched at once and the
+    forecast hours are read, classified (and rendered) on a thread pool
+
+    param layers : 3 layer of the 3 different thresholds
+    param fh : first forcast hour
+    param fh_end : last forcast hour
+    param fh_step : hours between the forecast hours
+    param mr : model run
+    param bbox : bounding box
+    param format_ : output format (geotiff, png or webp)
+
+    return : image_buffer : buffer of the file in bytes
+    """
+
+    gdal.UseExceptions()
+    bbox = convert_bbox(bbox)
+    if bbox is None:
+        LOGGER.error('Invalid bbox')
+        return None
+    if len(layers) != 3:
+        LOGGER.error('Invalid number of layers')
+        return None
+    if format_ not in ('geotiff', 'png', 'webp'):
+        LOGGER.error('invalid format')
+        return None
+
+    fhs = forecast_hours(fh, fh_end, fh_step)
+    if fhs is None:
+        LOGGER.error('Invalid forecast hour range (at most {} hours)'.format(
+            MAX_FORECAST_HOURS))
+        return None
+
+    sufix, model, tresholds = valid_layer(layers)
+    if sufix is None:
+        return None
+
+    with timed('generate-vigilance-range', 'lookup'):
+        if not prefetch_manifests(fhs, mr, model):
+            return None
+
+    sources = []
+    for fh_ in fhs:
+        files, variables = get_files(layers, fh_, mr)
+        if files is None:
+            return None
+
+        path, bands = get_bands(files)
+        if sufix == 'ERGE':
+            bands.sort()
+        if sufix == 'ERLE':
+            bands.sort(reverse=True)
+        sources.append((fh_, path, bands, variables[0]))
+
+    try:
+        bbox = snap_bbox(DATASETS.info(sources[0][1]).geotransform, bbox)
+    except RuntimeError as err:
+        LOGGER.error('unable to open {}: {}'.format(sources[0][1], err))
+        return None
+
+    key = cache_key('generate-vigilance-range', layers,
+                    [(fh_.strftime(DATE_FORMAT), bands, file_identity(path))
+                     for fh_, path, bands, _ in sources],
+                    mr.strftime(DATE_FORMAT), bbox, format_, FRAME_DURATION)
+    output = OUTPUTS.get(key)
+    if output is not None:
+        return output
+
+    def run(source):
+        fh_, path, bands, variable = source
+        with timed('generate-vigilance-range', 'read_classify'):
+            vigi_data = get_new_array(path, bands, bbox, workers=1)
+        if vigi_data is None or format_ == 'geotiff':
+            return vigi_data
+        textstr = get_data_text(variable, tresholds, mr, model, fh_)
+        with timed('generate-vigilance-range', 'render'):
+            return render(add_basemap, vigi_data, bbox, textstr)
+
+    with ThreadPoolExecutor(max_workers=max(VIGILANCE_WORKERS, 1)) as ex:
+        results = list(ex.map(run, sources))
+    if any(result is None for result in results):
+        return None
+
+    with timed('generate-vigilance-range', 'encode'):
+        if format_ == 'geotiff':
+            output = get_geotiff(np.stack(results), bbox, sources[0][1],
+                                 [fh_.strftime(DATE_FORMAT) for fh_ in fhs])
+        else:
+            output = get_animation(results, format_)
+
+    OUTPUTS.set(key, output)
+    return output
+
+
+def get_vigilance_output(layers, fh, mr, bbox, format_, fh_end=None,
+                         fh_step=None):
+    """
+    produce the vigilance process output
+
+    param layers : 3 layers to produce the vigilance
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param bbox : bounding box
+    param format_ : output format
+    param fh_end : last forcast hour datetime of a range (optional)
+    param fh_step : hours between the forecast hours of a range
+
+    return : output : GeoPNG dict or file bytes (empty when no data)
+    """
+
+    if fh_end is not None:
+        output = generate_vigilance_range(layers, fh, fh_end, fh_step, mr,
+                                          bbox, format_)
+    else:
+        output = generate_vigilance(layers, fh, mr, bbox, format_)
+    if output is None:
+        return BytesIO().getvalue()
+    elif format_ == 'geopng':
+        return output
+    return output.getvalue()
+
+
+def get_tile_output(layers, fh, mr, tile):
+    """
+    produce the vigilance process output of a tile
+
+    param layers : 3 layers to produce the vigilance
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param tile : tile as z/x/y
+
+    return : output : tile PNG bytes (empty when no data)
+    """
+
+    output = get_tile(layers, fh, mr, tile)
+    if output is None:
+        return BytesIO().getvalue()
+    return output.getvalue()
+
+
 @click.command('generate-vigilance')
 @click.pass_context
 @click.option('--layers', 'layers', help='3 layers for vigilance')
@@ -671,10 +1591,23 @@ def generate_vigilance(layers, fh, mr, bbox, format_):
               help='model run to use for the time serie')
 @click.option('--bbox', 'bbox', default=CANADA_BBOX, help='bounding box')
 @click.option('--format', 'format_', help='output format')
-def cli(ctx, layers, fh, mr, bbox, format_):
-
-    output = generate_vigilance(layers.split(','), fh, mr, bbox.split(','),
-                                format_.lower())
+@click.option('--tile', 'tile', help='z/x/y Web Mercator tile (PNG)')
+@click.option('--forecast-hour-end', 'fh_end',
+              type=click.DateTime(formats=[DATE_FORMAT]),
+              help='last forecast hour of a forecast hour range')
+@click.option('--forecast-hour-step', 'fh_step', type=int, default=24,
+              help='hours between the forecast hours of a range')
+def cli(ctx, layers, fh, mr, bbox, format_, tile, fh_end, fh_step):
+
+    if tile is not None:
+        output = get_tile(layers.split(','), fh, mr, tile)
+    elif fh_end is not None:
+        output = generate_vigilance_range(layers.split(','), fh, fh_end,
+                                          fh_step, mr, bbox.split(','),
+                                          format_.lower())
+    else:
+        output = generate_vigilance(layers.split(','), fh, mr,
+                                    bbox.split(','), format_.lower())
     if output is not None:
         click.echo(json.dumps('vigilance produced, curl via pygeoapi'))
     else:
@@ -700,26 +1633,34 @@ try:
             BaseProcessor.__init__(self, provider_def, PROCESS_METADATA)
 
         def execute(self, data):
-            layers = data['layers']
-            fh = datetime.strptime(data['forecast-hour'],
-                                   DATE_FORMAT)
-            mr = datetime.strptime(data['model-run'],
-                                   DATE_FORMAT)
-            bbox = data['bbox']
-            format_ = data['format'].lower()
-
             try:
-                output = generate_vigilance(layers.split(','),
-                                            fh, mr, bbox.split(','),
-                                            format_)
-                if output is not None:
-                    if format_ == "geopng":
-                        return output
-                    else:
-                        return output.getvalue()
-                else:
-                    return BytesIO().getvalue()
-            except ValueError as err:
+                if data.get('job-id'):
+                    return get_job_output(data['job-id'])
+
+                layers = data['layers']
+                fh = datetime.strptime(data['forecast-hour'],
+                                       DATE_FORMAT)
+                mr = datetime.strptime(data['model-run'],
+                                       DATE_FORMAT)
+
+                if data.get('tile'):
+                    return run_job(data.get('mode'), get_tile_output,
+                                   layers.split(','), fh, mr, data['tile'])
+
+                if not data.get('format'):
+                    raise ValueError('missing format')
+                bbox = data.get('bbox', CANADA_BBOX)
+                format_ = data['format'].lower()
+
+                fh_end = data.get('forecast-hour-end')
+                if fh_end is not None:
+                    fh_end = datetime.strptime(fh_end, DATE_FORMAT)
+                fh_step = int(data.get('forecast-hour-step', 24))
+
+                return run_job(data.get('mode'), get_vigilance_output,
+                               layers.split(','), fh, mr, bbox.split(','),
+                               format_, fh_end, fh_step)
+            except (JobQueueFull, RenderError, ValueError) as err:
                 msg = 'Process execution error: {}'.format(err)
                 LOGGER.error(msg)
                 raise ProcessorExecuteError(msg)
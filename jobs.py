@@ -0,0 +1,380 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from msc_pygeoapi.process.weather.util import decode_output, encode_output
+
+LOGGER = logging.getLogger(__name__)
+
+# threads running the asynchronous jobs
+JOB_WORKERS = int(os.environ.get('MSC_PYGEOAPI_JOB_WORKERS', 2))
+# directory of the job store, the jobs are kept in memory when not set
+JOB_DIR = os.environ.get('MSC_PYGEOAPI_JOB_DIR')
+# seconds a finished job (and its result) is kept
+JOB_TTL = int(os.environ.get('MSC_PYGEOAPI_JOB_TTL', 3600))
+# jobs accepted or running at once, new jobs are refused above it
+JOB_MAX_PENDING = int(os.environ.get('MSC_PYGEOAPI_JOB_MAX_PENDING', 16))
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# job ids are uuid4 hex strings, they are part of the job file names
+JOB_ID_PATTERN = re.compile('[0-9a-f]{32}')
+# keys of a job record, a job file missing one is an unknown job
+JOB_KEYS = ('id', 'status', 'created', 'started', 'finished', 'message')
+
+ACCEPTED = 'accepted'
+RUNNING = 'running'
+SUCCESSFUL = 'successful'
+FAILED = 'failed'
+
+_JOBS = None
+_JOBS_LOCK = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    """too many jobs are pending, the job is refused"""
+    pass
+
+
+def check_job_id(job_id):
+    """
+    validate a client supplied job id (raise ValueError)
+
+    param job_id : job id
+
+    return : job_id : job id
+    """
+
+    if not isinstance(job_id, str) or \
+            JOB_ID_PATTERN.fullmatch(job_id) is None:
+        raise ValueError('invalid job id: {}'.format(job_id))
+    return job_id
+
+
+def format_time(timestamp):
+    """
+    format a job timestamp
+
+    param timestamp : seconds since the epoch or None
+
+    return : date : UTC date string or None
+    """
+
+    if timestamp is None:
+        return None
+    return datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT)
+
+
+class JobManager(object):
+    """
+    run processes in the background and keep their status and result
+
+    the status of a job is kept in memory, and also written with its
+    result to the job directory when one is given, so every pygeoapi
+    worker process sharing the directory can answer for the job; the
+    result is written as raw bytes (or JSON) with its description in
+    the status file, it is never unpickled
+    """
+
+    def __init__(self, workers=JOB_WORKERS, directory=JOB_DIR, ttl=JOB_TTL,
+                 max_pending=JOB_MAX_PENDING):
+        """
+        param workers : number of threads running the jobs
+        param directory : directory of the job store (None for in memory)
+        param ttl : seconds a finished job is kept
+        param max_pending : jobs accepted or running at once
+        """
+
+        self.directory = directory
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._pending = threading.BoundedSemaphore(max(max_pending, 1))
+        self._jobs = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.directory, '{}.{}'.format(job_id, ext))
+
+    def _write(self, path, content, mode='w'):
+        # written next to the final path then renamed so a reader never
+        # sees a partial file
+        tmp = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp, mode) as fh:
+            if mode == 'wb':
+                fh.write(content)
+            else:
+                json.dump(content, fh)
+        os.replace(tmp, path)
+
+    def _update(self, job_id, **kwargs):
+        with self._lock:
+            job = self._jobs[job_id]
+            job.update(kwargs)
+            job = dict(job)
+
+        if self.directory is not None:
+            self._write(self._path(job_id, 'json'), job)
+
+    def _run(self, job_id, func, args):
+        try:
+            self._update(job_id, status=RUNNING, started=time.time(),
+                         message='job running')
+            try:
+                output = func(*args)
+                header = None
+                if self.directory is not None:
+                    content, header = encode_output(output)
+                    self._write(self._path(job_id, 'out'), content, 'wb')
+            except Exception as err:
+                LOGGER.error('job {} failed: {}'.format(job_id, err))
+                self._update(job_id, status=FAILED, finished=time.time(),
+                             message=str(err))
+                return
+
+            if header is None:
+                with self._lock:
+                    self._results[job_id] = output
+            self._update(job_id, status=SUCCESSFUL, finished=time.time(),
+                         message='job completed', output=header)
+        finally:
+            self._pending.release()
+
+    def _load(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(job_id, 'json')) as fh:
+                job = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(job, dict) or \
+                any(key not in job for key in JOB_KEYS):
+            LOGGER.warning('invalid job file {}'.format(job_id))
+            return None
+        return job
+
+    def _expired(self, job, now):
+        return (job.get('finished') is not None and
+                now - job['finished'] > self.ttl)
+
+    def expire(self):
+        """
+        remove the finished jobs older than the ttl, with their result
+
+        return : None
+        """
+
+        now = time.time()
+        with self._lock:
+            for job_id, job in list(self._jobs.items()):
+                if self._expired(job, now):
+                    del self._jobs[job_id]
+                    self._results.pop(job_id, None)
+
+        if self.directory is None:
+            return
+        for name in os.listdir(self.directory):
+            job_id, ext = os.path.splitext(name)
+            if ext != '.json' or JOB_ID_PATTERN.fullmatch(job_id) is None:
+                continue
+            job = self._load(job_id)
+            if job is not None and self._expired(job, now):
+                for ext in ('json', 'out'):
+                    try:
+                        os.remove(self._path(job_id, ext))
+                    except OSError:
+                        pass
+
+    def submit(self, func, *args):
+        """
+        start a job
+
+        param func : function producing the job output
+        param args : arguments of the function
+
+        return : status : status of the new job (raise JobQueueFull if
+                 too many jobs are pending)
+        """
+
+        if not self._pending.acquire(blocking=False):
+            raise JobQueueFull('too many pending jobs, retry later')
+
+        try:
+            self.expire()
+        except OSError as err:
+            LOGGER.warning('unable to expire jobs: {}'.format(err))
+
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'status': ACCEPTED,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+            'message': 'job accepted'
+        }
+        try:
+            with self._lock:
+                self._jobs[job_id] = job
+            if self.directory is not None:
+                self._write(self._path(job_id, 'json'), job)
+            self._executor.submit(self._run, job_id, func, args)
+        except Exception:
+            self._pending.release()
+            raise
+
+        return self.status(job_id)
+
+    def status(self, job_id):
+        """
+        get the status and timing of a job
+
+        param job_id : job id
+
+        return : status : job status or None if the job is unknown
+                 (raise ValueError if the job id is invalid)
+        """
+
+        job = self._load(check_job_id(job_id))
+        if job is None or self._expired(job, time.time()):
+            return None
+
+        duration = None
+        if job['started'] is not None:
+            duration = (job['finished'] or time.time()) - job['started']
+
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'created': format_time(job['created']),
+            'started': format_time(job['started']),
+            'finished': format_time(job['finished']),
+            'duration': duration,
+            'message': job['message']
+        }
+
+    def result(self, job_id):
+        """
+        get the output of a successful job
+
+        param job_id : job id
+
+        return : output : job output or None if not available
+                 (raise ValueError if the job id is invalid)
+        """
+
+        check_job_id(job_id)
+        with self._lock:
+            if job_id in self._results:
+                return self._results[job_id]
+
+        if self.directory is None:
+            return None
+
+        job = self._load(job_id)
+        if job is None or not job.get('output'):
+            return None
+        try:
+            with open(self._path(job_id, 'out'), 'rb') as fh:
+                return decode_output(fh.read(), job['output'])
+        except (OSError, ValueError, KeyError) as err:
+            LOGGER.error('invalid job output {}: {}'.format(job_id, err))
+            return None
+
+
+def get_jobs():
+    """
+    return the process-wide job manager, it is created on first use
+
+    return : jobs : JobManager
+    """
+
+    global _JOBS
+
+    if _JOBS is None:
+        with _JOBS_LOCK:
+            if _JOBS is None:
+                _JOBS = JobManager()
+    return _JOBS
+
+
+def get_job_output(job_id):
+    """
+    get the output of a job, or its status while it is not done
+
+    param job_id : job id
+
+    return : output : job output, or job status
+    """
+
+    jobs = get_jobs()
+    status = jobs.status(job_id)
+    if status is None:
+        raise ValueError('unknown job: {}'.format(job_id))
+    if status['status'] == SUCCESSFUL:
+        return jobs.result(job_id)
+    return status
+
+
+def run_job(mode, func, *args):
+    """
+    run a process synchronously or start it as a job
+
+    param mode : execution mode, sync or async (None for sync)
+    param func : function producing the process output
+    param args : arguments of the function
+
+    return : output : process output, or status of the started job
+    """
+
+    mode = (mode or 'sync').lower()
+    if mode == 'async':
+        return get_jobs().submit(func, *args)
+    elif mode != 'sync':
+        raise ValueError('invalid mode: {}'.format(mode))
+
+    return func(*args)
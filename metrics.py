@@ -0,0 +1,295 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# stage metrics are recorded unless set to false
+METRICS_ENABLED = os.environ.get('MSC_PYGEOAPI_METRICS',
+                                 'true').lower() != 'false'
+# level of the structured log line written for every stage
+METRICS_LOG_LEVEL = getattr(logging, os.environ.get(
+    'MSC_PYGEOAPI_METRICS_LOG_LEVEL', 'DEBUG').upper(), logging.DEBUG)
+
+# upper bounds (s) of the stage latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+STAGE_SECONDS = 'msc_pygeoapi_weather_stage_seconds'
+FILES_OPENED = 'msc_pygeoapi_weather_files_opened_total'
+BYTES_READ = 'msc_pygeoapi_weather_bytes_read_total'
+OUTPUT_CACHE = 'msc_pygeoapi_weather_output_cache_total'
+
+PROCESS_METADATA = {
+    'version': '0.1.0',
+    'id': 'weather-metrics',
+    'title': 'Weather processes metrics',
+    'description': 'stage latencies and counters of the weather ' +
+                   'processes, in the Prometheus text format',
+    'keywords': ['metrics', 'weather'],
+    'links': [],
+    'inputs': [],
+    'outputs': [{
+        'id': 'weather-metrics-response',
+        'title': 'Prometheus metrics',
+        'output': {
+            'formats': [{
+                'mimeType': 'text/plain'
+            }]
+        }
+    }],
+    'example': {
+        'inputs': []
+    }
+}
+
+HELP = {
+    STAGE_SECONDS: 'Latency of the weather process stages',
+    FILES_OPENED: 'GDAL datasets opened',
+    BYTES_READ: 'Raster bytes read',
+    OUTPUT_CACHE: 'Output cache lookups by result'
+}
+
+
+class Registry(object):
+    """thread safe registry of counters and latency histograms"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Initialize object
+
+        param buckets : upper bounds of the histogram buckets
+        """
+
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        increment a counter
+
+        param name : counter name
+        param value : increment
+        param labels : labels of the counter
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        record a value in a histogram
+
+        param name : histogram name
+        param value : observed value
+        param labels : labels of the histogram
+        """
+
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                    'count': 0
+                }
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def clear(self):
+        """forget every metric"""
+
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_prometheus(self):
+        """
+        format the metrics in the Prometheus text exposition format
+
+        return : text : Prometheus metrics
+        """
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(value, buckets=list(
+                value['buckets']))) for key, value in
+                self._histograms.items())
+
+        lines = []
+        names = set()
+
+        def header(name, type_):
+            if name not in names:
+                names.add(name)
+                lines.append('# HELP {} {}'.format(name, HELP.get(name,
+                                                                  name)))
+                lines.append('# TYPE {} {}'.format(name, type_))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, format_labels(labels),
+                                          value))
+
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            bounds = [repr(float(bound)) for bound in self.buckets]
+            for bound, count in zip(bounds + ['+Inf'],
+                                    histogram['buckets']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                              histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels),
+                                                histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    """
+    format the labels of a metric sample
+
+    param labels : tuple of (name, value) labels
+
+    return : labels : Prometheus labels ('' if there are none)
+    """
+
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+REGISTRY = Registry()
+
+
+def count(name, value=1, **labels):
+    """
+    increment a counter of the process-wide registry
+
+    param name : counter name
+    param value : increment
+    param labels : labels of the counter
+    """
+
+    if METRICS_ENABLED:
+        REGISTRY.inc(name, value, **labels)
+
+
+@contextmanager
+def timed(process, stage):
+    """
+    record the latency of a process stage in the stage histogram, and
+    write it as a structured (JSON) log line; it can also decorate a
+    function
+
+    param process : process name (ex: generate-vigilance)
+    param stage : stage name (ex: lookup, read, render)
+    """
+
+    if not METRICS_ENABLED:
+        yield
+        return
+
+    status = 'ok'
+    begin = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        seconds = time.perf_counter() - begin
+        REGISTRY.observe(STAGE_SECONDS, seconds, process=process,
+                         stage=stage, status=status)
+        if LOGGER.isEnabledFor(METRICS_LOG_LEVEL):
+            LOGGER.log(METRICS_LOG_LEVEL, json.dumps({
+                'metric': STAGE_SECONDS,
+                'process': process,
+                'stage': stage,
+                'status': status,
+                'seconds': round(seconds, 6),
+                'thread': threading.current_thread().name
+            }))
+
+
+def to_prometheus():
+    """
+    format the metrics of this process in the Prometheus text format
+
+    return : text : Prometheus metrics
+    """
+
+    return REGISTRY.to_prometheus()
+
+
+try:
+    from pygeoapi.process.base import BaseProcessor
+
+    class WeatherMetricsProcessor(BaseProcessor):
+        """Weather processes metrics Processor"""
+
+        def __init__(self, provider_def):
+            """
+            Initialize object
+
+            :param provider_def: provider definition
+
+            :returns:
+            pygeoapi.process.weather.metrics.WeatherMetricsProcessor
+             """
+
+            BaseProcessor.__init__(self, provider_def, PROCESS_METADATA)
+
+        def execute(self, data):
+            return to_prometheus()
+
+        def __repr__(self):
+            return '<WeatherMetricsProcessor> {}'.format(self.name)
+except (ImportError, RuntimeError):
+    pass
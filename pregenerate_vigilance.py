@@ -0,0 +1,259 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import click
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from datetime import timedelta
+import json
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from msc_pygeoapi.process.weather import render
+from msc_pygeoapi.process.weather.cache import OUTPUTS
+from msc_pygeoapi.process.weather.generate_vigilance import (
+    bbox_window, classify, convert_bbox, DATE_FORMAT, get_bands, get_files,
+    get_manifest, get_output, snap_bbox, valid_layer, VIGILANCE_THRESHOLDS,
+    vigilance_key)
+from msc_pygeoapi.process.weather.util import DATASETS
+
+LOGGER = logging.getLogger(__name__)
+
+# processes generating the forecast hours of a model run
+PREGENERATE_WORKERS = int(os.environ.get('MSC_PYGEOAPI_PREGENERATE_WORKERS',
+                                         os.cpu_count() or 1))
+
+
+def init_worker():
+    """
+    initialize a pre-generation process, it renders its PNGs itself
+    instead of sending them to a render pool
+    """
+
+    render.RENDER_WORKERS = 0
+
+
+def union_window(windows):
+    """
+    find the raster window covering all the windows
+
+    param windows : list of (col, row, ncols, nrows) windows
+
+    return : window : (col, row, ncols, nrows) window
+    """
+
+    col = min(window[0] for window in windows)
+    row = min(window[1] for window in windows)
+    col2 = max(window[0] + window[2] for window in windows)
+    row2 = max(window[1] + window[3] for window in windows)
+    return col, row, col2 - col, row2 - row
+
+
+def get_products(fh, mr, config):
+    """
+    find the products of a forecast hour, grouped by source file
+
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param config : pre-generation configuration
+
+    return : products : dict of path: list of (layers, bands, variable,
+                        tresholds, model)
+    """
+
+    products = {}
+    for layers in config['layers']:
+        sufix, model, tresholds = valid_layer(layers)
+        if sufix is None:
+            continue
+
+        files, variables = get_files(layers, fh, mr)
+        if files is None:
+            continue
+
+        path, bands = get_bands(files)
+        if sufix == 'ERGE':
+            bands.sort()
+        if sufix == 'ERLE':
+            bands.sort(reverse=True)
+
+        products.setdefault(path, []).append(
+            (layers, bands, variables[0], tresholds, model))
+    return products
+
+
+def pregenerate_hour(fh, mr, config):
+    """
+    generate and cache the configured products of a forecast hour, each
+    source band is read once over the window of all the bboxes
+
+    param fh : forcast hour datetime
+    param mr : model run datetime
+    param config : pre-generation configuration
+
+    return : count : number of outputs generated
+    """
+
+    layers = [layer for triplet in config['layers'] for layer in triplet]
+    if get_manifest(fh, mr, layers) is None:
+        return 0
+
+    bboxes = [convert_bbox(bbox.split(',')) for bbox in config['bboxes']]
+    formats = [format_.lower() for format_ in config['formats']]
+    count = 0
+
+    for path, products in get_products(fh, mr, config).items():
+        try:
+            geotransform = DATASETS.info(path).geotransform
+        except RuntimeError as err:
+            LOGGER.error('unable to open {}: {}'.format(path, err))
+            continue
+
+        # products already in cache are skipped
+        jobs = []
+        for bbox in bboxes:
+            if bbox is None:
+                continue
+            bbox = snap_bbox(geotransform, bbox)
+            for product in products:
+                keys = [(format_, vigilance_key(product[0], product[1], fh,
+                                                mr, bbox, format_, path))
+                        for format_ in formats]
+                keys = [item for item in keys if item[1] not in OUTPUTS]
+                if keys:
+                    jobs.append((bbox, bbox_window(geotransform, bbox),
+                                 product, keys))
+        if not jobs:
+            continue
+
+        window = union_window([job[1] for job in jobs])
+        col, row, ncols, nrows = window
+        bands = sorted(set(band for job in jobs for band in job[2][1]))
+
+        try:
+            with DATASETS.open(path) as ds:
+                arrays = {}
+                for band in bands:
+                    arrays[band] = ds.GetRasterBand(band).ReadAsArray(
+                        col, row, ncols, nrows,
+                        buf_obj=np.empty((nrows, ncols), dtype=np.float32))
+        except RuntimeError as err:
+            LOGGER.error('Cannot open file: {}'.format(err))
+            continue
+
+        for bbox, (col_, row_, ncols_, nrows_), product, keys in jobs:
+            layers, bands_, variable, tresholds, model = product
+            rows = slice(row_ - row, row_ - row + nrows_)
+            cols = slice(col_ - col, col_ - col + ncols_)
+
+            vigi_data = np.zeros((nrows_, ncols_), dtype=np.uint8)
+            for band, thresholds in zip(bands_, VIGILANCE_THRESHOLDS):
+                classify(arrays[band][rows, cols], thresholds, vigi_data)
+
+            for format_, key in keys:
+                output = get_output(vigi_data, bbox, path, format_, variable,
+                                    tresholds, mr, model, fh)
+                if output is not None:
+                    OUTPUTS.set(key, output)
+                    count += 1
+
+    LOGGER.debug('{} outputs generated for {}'.format(
+        count, fh.strftime(DATE_FORMAT)))
+    return count
+
+
+def pregenerate(mr, config, workers=None):
+    """
+    generate and cache the configured vigilance products of a model run,
+    the forecast hours are generated on a process pool
+
+    param mr : model run datetime
+    param config : pre-generation configuration, dict of
+                   layers : list of 3 layers triplets
+                   forecast_hours : list of hours after the model run
+                   bboxes : list of "x_min, y_min, x_max, y_max"
+                   formats : list of output formats
+    param workers : number of processes (default PREGENERATE_WORKERS)
+
+    return : count : number of outputs generated
+    """
+
+    if workers is None:
+        workers = PREGENERATE_WORKERS
+
+    fhs = [mr + timedelta(hours=int(hour))
+           for hour in config['forecast_hours']]
+    count = 0
+
+    if workers <= 1:
+        init_worker()
+        for fh in fhs:
+            count += pregenerate_hour(fh, mr, config)
+        return count
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(fhs)),
+                             mp_context=context,
+                             initializer=init_worker) as executor:
+        futures = {executor.submit(pregenerate_hour, fh, mr, config): fh
+                   for fh in fhs}
+        for future in as_completed(futures):
+            try:
+                count += future.result()
+            except Exception as err:
+                LOGGER.error('pre-generation of {} failed: {}'.format(
+                    futures[future].strftime(DATE_FORMAT), err))
+
+    return count
+
+
+@click.command('pregenerate-vigilance')
+@click.pass_context
+@click.option('--model-run', 'mr', required=True,
+              type=click.DateTime(formats=[DATE_FORMAT]),
+              help='model run to pre-generate')
+@click.option('--config', 'config', required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON file of the layers, forecast hours, bboxes and '
+                   'formats to pre-generate')
+@click.option('--workers', 'workers', type=int, default=None,
+              help='number of processes')
+def cli(ctx, mr, config, workers):
+
+    if OUTPUTS.directory is None:
+        raise click.ClickException(
+            'MSC_PYGEOAPI_CACHE_DIR is needed to share the outputs')
+
+    with open(config) as fh:
+        config = json.load(fh)
+
+    count = pregenerate(mr, config, workers)
+    click.echo('{} vigilance outputs generated'.format(count))
@@ -0,0 +1,373 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import click
+from datetime import datetime
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+from osgeo import gdal
+
+from msc_pygeoapi.process.weather.metrics import BYTES_READ, count
+
+LOGGER = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# directory of the cubes, no cube is used if not set
+CUBE_DIR = os.environ.get('MSC_PYGEOAPI_RDPA_CUBE_DIR')
+# time steps added to a cube when it is full
+CUBE_GROWTH = 124
+
+_CUBES = {}
+_CUBES_LOCK = threading.Lock()
+
+
+def layer_cumul(layer):
+    """
+    find if a rdpa layer is a 24h or 6h accumulation
+
+    layer : layer name (ex: RDPA.24P_PR)
+
+    return : 24, 6 or 0 if unknown
+    """
+
+    match = re.match(r'RDPA\.(\d+)[A-Z]_', layer)
+    if match is not None and int(match.group(1)) in (6, 24):
+        return int(match.group(1))
+    return 0
+
+
+def file_date(path):
+    """
+    find the forecast hour datetime of a rdpa file from its name
+
+    path : rdpa file path
+
+    return : forecast hour datetime (DATE_FORMAT), None if not found
+    """
+
+    match = re.search(r'(\d{8})T?(\d{2})', os.path.basename(path))
+    if match is None:
+        return None
+
+    date = datetime.strptime(''.join(match.groups()), '%Y%m%d%H')
+    return date.strftime(DATE_FORMAT)
+
+
+def to_datetime64(dates):
+    """
+    convert DATE_FORMAT dates to a datetime64 array
+
+    dates : list of dates
+
+    return : datetime64[s] array
+    """
+
+    return np.array(dates, dtype='U19').astype('datetime64[s]')
+
+
+class RdpaCube(object):
+    """
+    append-only memory-mapped (time, y, x) cube of the grids of a rdpa
+    layer, the history of a point is read as one strided slice
+    """
+
+    def __init__(self, directory, layer):
+        """
+        Initialize object
+
+        param directory : directory of the cube files
+        param layer : rdpa layer of the cube
+        """
+
+        self.layer = layer
+        self.cumul = layer_cumul(layer)
+        self.data_path = os.path.join(directory, '{}.dat'.format(layer))
+        self.index_path = os.path.join(directory, '{}.json'.format(layer))
+        # (index, memory map, datetime64 dates), replaced as a whole
+        self.state = (None, None, None)
+        # (inode, mtime ns, size) of the loaded index file
+        self.version = None
+        self.reload()
+
+    def reload(self):
+        """
+        (re)load the cube index and memory map if it was modified
+
+        return : True if the cube exists
+        """
+
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return False
+
+        # the index is replaced on every append, it grows with the dates
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            with open(self.index_path) as fh:
+                index = json.load(fh)
+
+            data = np.memmap(self.data_path, dtype=np.float32, mode='r',
+                             shape=tuple([index['capacity']] +
+                                         index['shape']))
+            self.state = (index, data, to_datetime64(index['dates']))
+            self.version = version
+
+        return True
+
+    @property
+    def index(self):
+        return self.state[0]
+
+    @property
+    def geotransform(self):
+        return self.index['geotransform']
+
+    @property
+    def projection(self):
+        return self.index['projection']
+
+    def covers(self, date_begin, date_end):
+        """
+        check if the cube holds the dates between date_begin and date_end
+
+        date_begin : begin date (DATE_FORMAT)
+        date_end : end date (DATE_FORMAT)
+
+        return : True if the cube covers the dates
+        """
+
+        dates = self.state[2]
+        if dates is None or len(dates) == 0:
+            return False
+
+        begin, end = to_datetime64([date_begin, date_end])
+        return dates[0] <= begin and dates[-1] >= end
+
+    def get_values(self, cols, rows, date_begin, date_end):
+        """
+        read the history of pixels between two dates, 24h accumulations
+        are kept at the time of the last date found (as the files found
+        by ES)
+
+        cols : pixel columns
+        rows : pixel rows
+        date_begin : begin date (DATE_FORMAT)
+        date_end : end date (DATE_FORMAT)
+
+        return : raster values (one row per date and one column per
+                 point) and dates
+        """
+
+        index, cube, dates = self.state
+        cols = np.atleast_1d(cols)
+        rows = np.atleast_1d(rows)
+        begin, end = to_datetime64([date_begin, date_end])
+
+        start = np.searchsorted(dates, begin, side='left')
+        stop = np.searchsorted(dates, end, side='right')
+        steps = np.arange(start, stop)
+
+        if self.cumul == 24 and len(steps) > 0:
+            seconds = dates[steps].astype(np.int64) % 86400
+            steps = steps[seconds == seconds[-1]]
+
+        ny, nx = index['shape']
+        valid = (cols >= 0) & (cols < nx) & (rows >= 0) & (rows < ny)
+        if not valid.all():
+            msg = 'Invalid coordinates : {}' .format(
+                list(zip(cols[~valid].tolist(), rows[~valid].tolist())))
+            LOGGER.error(msg)
+
+        values = np.zeros((len(steps), cols.size), dtype=np.float32)
+        if len(steps) > 0 and valid.any():
+            block = cube[steps[0]:steps[-1] + 1, rows[valid], cols[valid]]
+            count(BYTES_READ, block.nbytes)
+            values[:, valid] = block[steps - steps[0]]
+
+        data = {
+            'values': values,
+            'dates': [index['dates'][step] for step in steps]
+        }
+        return data
+
+
+def get_cube(layer, directory=None):
+    """
+    return the cube of a rdpa layer
+
+    layer : rdpa layer
+    directory : directory of the cube files (default CUBE_DIR)
+
+    return : cube : RdpaCube, None if there is no cube for the layer
+    """
+
+    directory = directory or CUBE_DIR
+    if directory is None or layer_cumul(layer) == 0:
+        return None
+
+    with _CUBES_LOCK:
+        cube = _CUBES.get((directory, layer))
+        if cube is None:
+            cube = RdpaCube(directory, layer)
+            _CUBES[(directory, layer)] = cube
+
+        if cube.reload():
+            return cube
+
+    return None
+
+
+def write_index(path, index):
+    """
+    atomically write the index of a cube
+
+    path : index file path
+    index : cube index
+    """
+
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fh:
+        json.dump(index, fh)
+    os.replace(tmp, path)
+
+
+def append_file(directory, layer, path, date):
+    """
+    append a rdpa file to the cube of its layer, the dates of a cube
+    can only increase (files already in the cube are skipped); appends
+    to a cube are serialized with an exclusive lock on its lock file
+
+    directory : directory of the cube files
+    layer : rdpa layer
+    path : rdpa grib file
+    date : forecast hour datetime of the file (DATE_FORMAT)
+
+    return : True if the file was appended
+    """
+
+    # the index file is replaced on every append, so a separate file is
+    # locked
+    lock_path = os.path.join(directory, '{}.lock'.format(layer))
+    with open(lock_path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _append_file(directory, layer, path, date)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _append_file(directory, layer, path, date):
+    """
+    append a rdpa file to the cube of its layer (the cube lock must be
+    held, see append_file)
+    """
+
+    cube = RdpaCube(directory, layer)
+    index = cube.index
+
+    ds = gdal.Open(path)
+    if ds is None:
+        raise RuntimeError(gdal.GetLastErrorMsg())
+    array = ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    geotransform = list(ds.GetGeoTransform())
+
+    if index is None:
+        index = {
+            'layer': layer,
+            'shape': list(array.shape),
+            'geotransform': geotransform,
+            'projection': ds.GetProjection(),
+            'capacity': 0,
+            'dates': [],
+            'files': []
+        }
+
+    if list(array.shape) != index['shape'] or \
+            geotransform != index['geotransform']:
+        raise ValueError('{} grid does not match the cube grid'.format(path))
+
+    if index['dates'] and date <= index['dates'][-1]:
+        if date in index['dates']:
+            LOGGER.info('{} already in the cube'.format(path))
+            return False
+        raise ValueError('{} is older than the end of the cube ({})'.format(
+            path, index['dates'][-1]))
+
+    step = len(index['dates'])
+    if step >= index['capacity']:
+        index['capacity'] += CUBE_GROWTH
+        with open(cube.data_path, 'ab') as fh:
+            fh.truncate(index['capacity'] * array.nbytes)
+
+    data = np.memmap(cube.data_path, dtype=np.float32, mode='r+',
+                     shape=tuple([index['capacity']] + index['shape']))
+    data[step] = array
+    data.flush()
+    del data
+
+    # the index is written last so readers never see a partial grid
+    index['dates'].append(date)
+    index['files'].append(path)
+    write_index(cube.index_path, index)
+    return True
+
+
+@click.command('rdpa-cube-ingest')
+@click.pass_context
+@click.option('--layer', help='rdpa layer (ex: RDPA.24P_PR)', required=True)
+@click.option('--file', 'files', help='rdpa grib file (repeat for several)',
+              multiple=True, required=True)
+@click.option('--directory', help='cube directory', default=CUBE_DIR,
+              required=CUBE_DIR is None)
+def cli(ctx, layer, files, directory):
+    if layer_cumul(layer) == 0:
+        raise click.ClickException('Invalid rdpa layer: {}'.format(layer))
+
+    dated = []
+    for file_ in files:
+        date = file_date(file_)
+        if date is None:
+            raise click.ClickException(
+                'Cannot find the date of {}'.format(file_))
+        dated.append((date, file_))
+
+    os.makedirs(directory, exist_ok=True)
+    for date, file_ in sorted(dated):
+        try:
+            if append_file(directory, layer, file_, date):
+                click.echo('{} appended ({})'.format(file_, date))
+        except (RuntimeError, ValueError) as error:
+            raise click.ClickException(str(error))
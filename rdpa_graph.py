@@ -28,22 +28,45 @@
 # =================================================================
 
 import click
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import datetime, timedelta
 import json
 import logging
-import matplotlib.pyplot as plt
+import os
 from io import BytesIO
 
-
-from elasticsearch import Elasticsearch, exceptions
-from osgeo import gdal, osr
-from pyproj import Proj, transform
+from elasticsearch import exceptions
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+from pyproj import CRS, Transformer
+
+from msc_pygeoapi.process.weather.cache import cache_key, OUTPUTS
+from msc_pygeoapi.process.weather.jobs import (get_job_output,
+                                               JobQueueFull, run_job)
+from msc_pygeoapi.process.weather.metrics import BYTES_READ, count, timed
+from msc_pygeoapi.process.weather.rdpa_cube import get_cube, to_datetime64
+from msc_pygeoapi.process.weather.render import (render,
+                                                 RenderError)
+from msc_pygeoapi.process.weather.util import (DATASETS, file_identity,
+                                               get_es, LRUCache,
+                                               search_pages)
 
 LOGGER = logging.getLogger(__name__)
 # ne pas oublier logger level est a debug:
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 ES_INDEX = 'geomet-data-registry-tileindex'
+# number of threads reading the rasters of a serie (1 to read sequentially)
+READ_WORKERS = int(os.environ.get('MSC_PYGEOAPI_RDPA_READ_WORKERS', 4))
+# the pixels are read one by one when their bounding window holds more
+# than this many pixels per point (widely spread points)
+SPARSE_READ_FACTOR = int(os.environ.get('MSC_PYGEOAPI_RDPA_SPARSE_READ',
+                                        64))
+# lat long to dataset projection transformers, by projection
+TRANSFORMERS = LRUCache(16)
 
 PROCESS_METADATA = {
     'version': '0.1.0',
@@ -108,7 +131,7 @@ PROCESS_METADATA = {
     }, {
         'id': 'x',
         'title': 'x coordinate',
-        'description': 'longitude',
+        'description': 'longitude (or list of longitudes)',
         'input': {
             'literalDataDomain': {
                 'dataType': 'float',
@@ -117,12 +140,12 @@ PROCESS_METADATA = {
                 }
             }
         },
-        'minOccurs': 1,
+        'minOccurs': 0,
         'maxOccurs': 1
     }, {
         'id': 'y',
         'title': 'y coordinate',
-        'description': 'latitude',
+        'description': 'latitude (or list of latitudes)',
         'input': {
             'literalDataDomain': {
                 'dataType': 'float',
@@ -131,7 +154,22 @@ PROCESS_METADATA = {
                 }
             }
         },
-        'minOccurs': 1,
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'points',
+        'title': 'points',
+        'description': 'GeoJSON MultiPoint (or list of [x, y]) to use '
+                       'instead of x and y, output is a FeatureCollection',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
         'maxOccurs': 1
     }, {
         'id': 'time_step',
@@ -161,6 +199,38 @@ PROCESS_METADATA = {
         },
         'minOccurs': 1,
         'maxOccurs': 1
+    }, {
+        'id': 'mode',
+        'title': 'execution mode',
+        'description': 'sync (default) or async, async returns a job ' +
+                       'status right away and runs the process in the ' +
+                       'background',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
+    }, {
+        'id': 'job-id',
+        'title': 'job id',
+        'description': 'id of an async job, returns the job output once ' +
+                       'it is done or the job status until then (the ' +
+                       'other inputs are ignored)',
+        'input': {
+            'literalDataDomain': {
+                'dataType': 'string',
+                'valueDefinition': {
+                    'anyValue': True
+                }
+            }
+        },
+        'minOccurs': 0,
+        'maxOccurs': 1
     }],
     'outputs': [{
         'id': 'rdpa-graph-response',
@@ -226,101 +296,238 @@ def valid_dates(date):
     return date
 
 
-def query_es(es_object, index_name, date_end, date_begin, layer):
-
+def es_query(date_end, date_begin, layer, time_=None):
     """
-    find documents that fit with search param
+    ES query of the documents that fit with search param
 
-    es_object : ES server
-    index_name : index name in ES server to look into
     date_end : max forecast hour datetime value to match docs
     date_begin : min forecast hour datetime value to match docs
     layer : layers to match docs
+    time_ : only match docs with this forecast hour time (HH:MM:SSZ)
 
-    return : json of the search result
-
+    return : query
     """
 
-    s_object = {
-        'size': 124,              # result limit 1 month
-        'query':
+    query = {
+        'bool':
         {
-            'bool':
+            'must':
             {
-                'must':
+                'range':
                 {
-                    'range':
+                    'properties.forecast_hour_datetime':
                     {
-                        'properties.forecast_hour_datetime':
-                        {
-                            'lte': date_end,
-                            'gte': date_begin
-                        }
+                        'lte': date_end,
+                        'gte': date_begin
                     }
-                },
-                'filter':
-                {
-                    'term': {"properties.layer.raw": layer}
                 }
-            }
+            },
+            'filter':
+            [
+                {'term': {"properties.layer.raw": layer}}
+            ]
         }
     }
 
-    try:
-        res = es_object.search(index=index_name, body=s_object)
+    if time_ is not None:
+        # the datetimes at this time of every day are matched on the
+        # indexed date, no script is run on every document
+        date = datetime.strptime(date_begin[:10] + 'T' + time_, DATE_FORMAT)
+        end = datetime.strptime(date_end, DATE_FORMAT)
+        dates = []
+        while date <= end:
+            dates.append(date.strftime(DATE_FORMAT))
+            date += timedelta(days=1)
+
+        query['bool']['filter'].append({
+            'terms': {'properties.forecast_hour_datetime': dates}
+        })
+
+    return query
 
-    except exceptions.ElasticsearchException as error:
-        msg = 'ES search error: {}' .format(error)
-        LOGGER.error(msg)
-        return None, None
 
-    res_sorted = sorted(res['hits']['hits'],
-                        key=lambda i: i['_source']['properties']
-                        ['forecast_hour_datetime'])
+def query_es(es_object, index_name, date_end, date_begin, layer,
+             time_=None):
 
-    return res_sorted, res['hits']['total']['value']
+    """
+    find documents that fit with search param, the documents are
+    streamed page by page (no result limit)
 
+    es_object : ES server
+    index_name : index name in ES server to look into
+    date_end : max forecast hour datetime value to match docs
+    date_begin : min forecast hour datetime value to match docs
+    layer : layers to match docs
+    time_ : only match docs with this forecast hour time (HH:MM:SSZ)
 
-def xy_2_raster_data(path, x, y):
+    return : generator of the documents sorted by forecast hour datetime
+             (raise ElasticsearchException while iterating on ES error)
 
     """
-    convert coordinate to x, y raster coordinate and
-    return the x,y value of the raster
 
-    path : where the grib raster file is located
-    x : x coordinate
-    y : y coordinate
+    s_object = {
+        '_source': ['properties.filepath',
+                    'properties.forecast_hour_datetime'],
+        'query': es_query(date_end, date_begin, layer, time_),
+        'sort': [{'properties.forecast_hour_datetime': 'asc'}]
+    }
+
+    return search_pages(es_object, index_name, s_object)
+
+
+def query_es_last(es_object, index_name, date_end, date_begin, layer):
 
-    return : raster value in x, y position
     """
+    find the last document that fit with search param, and the number
+    of documents that fit
 
-    try:
-        grib = gdal.Open(path)
+    es_object : ES server
+    index_name : index name in ES server to look into
+    date_end : max forecast hour datetime value to match docs
+    date_begin : min forecast hour datetime value to match docs
+    layer : layers to match docs
 
-        transform = grib.GetGeoTransform()
+    return : properties (filepath and forecast hour datetime)
+             of the document (None if no document found) and the
+             number of documents found
 
-        org_x = transform[0]
-        org_y = transform[3]
+    """
 
-        pix_w = transform[1]
-        pix_h = transform[5]
+    s_object = {
+        'size': 1,
+        'track_total_hits': True,
+        '_source': ['properties.filepath',
+                    'properties.forecast_hour_datetime'],
+        'query': es_query(date_end, date_begin, layer),
+        'sort': [{'properties.forecast_hour_datetime': 'desc'}]
+    }
 
-        x = int((x - org_x) / pix_w)
-        y = int((y - org_y) / pix_h)
+    res = es_object.search(index=index_name, body=s_object)
 
-        try:
-            band1 = grib.GetRasterBand(1).ReadAsArray()
-            return band1[y][x]
+    total = res['hits']['total']
+    if isinstance(total, dict):
+        total = total['value']
 
-        except IndexError as error:
-            msg = 'Invalid coordinates : {}' .format(error)
-            LOGGER.error(msg)
+    for doc in res['hits']['hits']:
+        return doc['_source']['properties'], total
+
+    return None, total
+
+
+def xy_2_pixel(geotransform, x, y):
+    """
+    convert coordinates into (col, row) pixel positions of a raster
+
+    geotransform : geotransform of the raster
+    x : x coordinate(s)
+    y : y coordinate(s)
+
+    return : col, row : pixel position(s)
+    """
+
+    col = np.floor((np.asarray(x) - geotransform[0]) / geotransform[1])
+    row = np.floor((np.asarray(y) - geotransform[3]) / geotransform[5])
+    return col.astype(int), row.astype(int)
+
+
+def read_pixels(path, cols, rows):
+    """
+    read a set of pixels of a raster, only the window holding the
+    pixels is read and they are gathered with one fancy-index read;
+    widely spread pixels (window much larger than the number of pixels)
+    are read one by one instead
+
+    path : where the grib raster file is located
+    cols : pixel columns
+    rows : pixel rows
+
+    return : values : float32 array of the raster values at
+                      (cols, rows), 0 where a pixel can't be read
+    """
+
+    cols = np.atleast_1d(cols)
+    rows = np.atleast_1d(rows)
+    values = np.zeros(cols.shape, dtype=np.float32)
+
+    try:
+        with DATASETS.open(path) as grib:
+            band = grib.GetRasterBand(1)
+            valid = ((cols >= 0) & (cols < band.XSize) &
+                     (rows >= 0) & (rows < band.YSize))
+
+            if not valid.all():
+                msg = 'Invalid coordinates : {}' .format(
+                    list(zip(cols[~valid].tolist(), rows[~valid].tolist())))
+                LOGGER.error(msg)
+
+            if valid.any():
+                cols = cols[valid]
+                rows = rows[valid]
+                col0 = int(cols.min())
+                row0 = int(rows.min())
+                xsize = int(cols.max()) - col0 + 1
+                ysize = int(rows.max()) - row0 + 1
+
+                if xsize * ysize > SPARSE_READ_FACTOR * cols.size:
+                    pixels, index = np.unique(np.stack([cols, rows]),
+                                              axis=1, return_inverse=True)
+                    read = np.empty(pixels.shape[1], dtype=np.float32)
+                    for i, (col, row) in enumerate(pixels.T.tolist()):
+                        pixel = band.ReadAsArray(col, row, 1, 1)
+                        count(BYTES_READ, pixel.nbytes)
+                        read[i] = pixel[0, 0]
+                    values[valid] = read[index.ravel()]
+                else:
+                    window = band.ReadAsArray(col0, row0, xsize, ysize)
+                    count(BYTES_READ, window.nbytes)
+                    values[valid] = window[rows - row0, cols - col0]
 
     except RuntimeError as error:
         msg = 'can\'t open file : {}' .format(error)
         LOGGER.error(msg)
 
-    return 0
+    return values
+
+
+def sample_points(jobs, workers=None):
+    """
+    point-sampling engine, read the requested pixels for each
+    (file, pixels) job, every file is opened once
+
+    jobs can be a generator, reads start as soon as the first jobs are
+    produced and at most 2 * workers reads are pending at a time
+
+    jobs : iterable of (path, (cols, rows)) jobs
+    workers : size of the thread pool reading the files
+              (default READ_WORKERS, 1 to read sequentially)
+
+    return : values : float32 array of the sampled values, one row per
+                      job (in jobs order) and one column per pixel
+                      (0 where a pixel can't be read)
+    """
+
+    if workers is None:
+        workers = READ_WORKERS
+
+    rows = []
+
+    if workers > 1:
+        # GDAL releases the GIL during I/O, results are kept in jobs order
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, pixels in jobs:
+                pending.append(executor.submit(read_pixels, path, *pixels))
+                if len(pending) >= 2 * workers:
+                    rows.append(pending.popleft().result())
+
+            rows.extend(future.result() for future in pending)
+    else:
+        rows = [read_pixels(path, *pixels) for path, pixels in jobs]
+
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    return np.stack(rows)
 
 
 def _24_or_6(file):
@@ -342,102 +549,154 @@ def _24_or_6(file):
         return 0
 
 
-def get_values(res, x, y, cumul):
+def get_pixel(path, x, y):
+    """
+    find the pixel position of coordinates in a raster file
+
+    path : where the grib raster file is located
+    x : x coordinate(s)
+    y : y coordinate(s)
+
+    return : col, row : pixel position(s), -1 if the file can't be opened
+    """
+
+    try:
+        return xy_2_pixel(DATASETS.info(path).geotransform, x, y)
+
+    except RuntimeError as error:
+        msg = 'can\'t open file : {}' .format(error)
+        LOGGER.error(msg)
+
+    return np.full(np.size(x), -1), np.full(np.size(y), -1)
+
+
+def get_values(res, x, y, cumul, workers=None, time_=None):
     """
     get the raw raster values at (x, y) for each document
-    found by ES
+    found by ES, the documents are sampled as they are streamed
 
-    res : ES search result
-    x : x coordinate
-    y : y coordinate
+    res : ES search result (iterable of documents)
+    x : x coordinate(s)
+    y : y coordinate(s)
     cummul : 24h or 6h accumulation files
+    workers : size of the thread pool reading the files
+    time_ : time (HH:MM:SSZ) of the 24h accumulations to keep, default
+            is the time of the last document (already filtered by ES
+            when query_es is given time_)
 
-    return : (x, y) raster values and dates
+    return : (x, y) raster values (one row per date and one column
+             per point) and dates
 
     """
 
     data = {
-        'values': [],
+        'values': np.zeros((0, np.size(x)), dtype=np.float32),
         'dates': []
     }
 
-    if cumul == 6:
+    if cumul != 6 and cumul != 24:
+        return data
+
+    if cumul == 24 and time_ is None:      # use half of the documents
+        res = list(res)
+        if res:
+            date_ = res[-1]['_source']['properties']['forecast_hour_datetime']
+            date_, time_ = date_.split('T')
+
+    def jobs():
+        pixel = None
         for doc in res:
             file_path = doc['_source']['properties']['filepath']
             date = doc['_source']['properties']['forecast_hour_datetime']
-            val = xy_2_raster_data(file_path, x, y)
-            data['values'].append(val)
-            data['dates'].append(date)
-
-    elif cumul == 24:      # use half of the documents
 
-        date_ = res[-1]['_source']['properties']['forecast_hour_datetime']
-        date_, time_ = date_.split('T')
+            if cumul == 24:
+                tmp, time = date.split('T')
+                if time != time_:
+                    continue
 
-        for doc in res:
+            if pixel is None:
+                # the RDPA grid is the same for every file of the serie
+                pixel = get_pixel(file_path, x, y)
 
-            file_path = doc['_source']['properties']['filepath']
-            date = doc['_source']['properties']['forecast_hour_datetime']
-            tmp, time = date.split('T')
+            data['dates'].append(date)
+            yield file_path, pixel
 
-            if time == time_:
-                val = xy_2_raster_data(file_path, x, y)
-                data['values'].append(val)
-                data['dates'].append(date)
+    values = sample_points(jobs(), workers)
+    if len(values) > 0:
+        data['values'] = values
 
     return data
 
 
-def get_graph_arrays(values, time_step):
+def graph_arrays(values, dates, time_step):
     """
-    Produce the arrays for the graph accordingly to the time step
+    bin raw values by time step
 
-    values : raw (x, y) raster values and dates
+    values : float32 array of raw values (one row per date, optionally
+             one column per point)
+    dates : sorted dates of the values (DATE_FORMAT)
     time_step : time step for the graph in hours
 
-    return : data : json that contains 3 arrays :
-                        values : rdpa value for 24h
-                        total_value : total rdpa value since the begin date
-                        date : date of rdpa values
+    return : values : sum of the values of each time step
+             total_values : cumulative sum of values
+             dates : datetime64 start date of each time step
     """
 
-    data = {
-        'values': [],
-        'total_values': [],
-        'dates': []
-    }
+    values = np.asarray(values, dtype=np.float32)
+    dates = to_datetime64(dates)
+    step = np.timedelta64(int(time_step * 3600), 's')
+
+    if step > np.timedelta64(0, 's'):
+        edges = dates[0] + step * np.arange((dates[-1] - dates[0]) // step + 1)
+        starts = np.searchsorted(dates, edges)
+        # keep the time steps with at least one value
+        non_empty = starts < np.append(starts[1:], len(dates))
+        edges = edges[non_empty]
+        starts = starts[non_empty]
+    else:
+        edges = dates[:1]
+        starts = np.zeros(1, dtype=int)
 
-    date_c = values['dates'][0]
-    date_c = datetime.strptime(date_c, DATE_FORMAT)
-    total = 0
-    cmpt = -1
+    step_values = np.add.reduceat(values, starts, axis=0)
+    total_values = np.cumsum(step_values, axis=0)
+    return step_values, total_values, edges
 
-    for i in range(len(values['dates'])):
-        val = values['values'][i]
-        date = values['dates'][i]
-        date = datetime.strptime(date, DATE_FORMAT)
-        total += val
 
-        if date != date_c:
-            data['values'][cmpt] += val
-            data['total_values'][cmpt] += val
-        else:
-            data['values'].append(val)
-            data['total_values'].append(total)
-            data['dates'].append(date)
-            date_c = date + timedelta(hours=time_step)
-            cmpt += 1
+def format_dates(dates, time_step):
+    """
+    format the dates of the graph, only the day is kept for time steps
+    in days
+
+    dates : datetime64 dates
+    time_step : time step for the graph in hours
+
+    return : list of formatted dates
+    """
 
     if time_step >= 24 and (time_step % 24) == 0:
-        for i in range(len(data['dates'])):
-            date, time = datetime.strftime(data['dates'][i],
-                                           DATE_FORMAT).split('T')
-            data['dates'][i] = date
-    else:
-        for i in range(len(data['dates'])):
-            data['dates'][i] = datetime.strftime(data['dates'][i],
-                                                 '%Y-%m-%d %H:%M')
-    return data
+        return np.datetime_as_string(dates, unit='D').tolist()
+
+    dates = np.datetime_as_string(dates, unit='m')
+    return np.char.replace(dates, 'T', ' ').tolist()
+
+
+def get_transformer(wkt):
+    """
+    return the transformer from lat long coordinates to a projection,
+    transformers are cached by projection and shared between threads
+
+    wkt : projection (WKT)
+
+    return : transformer : pyproj Transformer
+    """
+
+    transformer = TRANSFORMERS.get(wkt)
+    if transformer is None:
+        transformer = Transformer.from_crs('EPSG:4326', CRS.from_wkt(wkt),
+                                           always_xy=True)
+        TRANSFORMERS.set(wkt, transformer)
+
+    return transformer
 
 
 def transform_coord(file, x, y):
@@ -451,13 +710,22 @@ def transform_coord(file, x, y):
     return : _x _y : coordinata in transformed projection
     """
 
-    ds = gdal.Open(file)
+    return transform_wkt(DATASETS.info(file).projection, x, y)
+
+
+def transform_wkt(wkt, x, y):
+    """
+    transform lat long coordinates into the given projection, arrays of
+    coordinates are transformed in one call
+
+    wkt : projection (WKT)
+    x : x coordinate(s) (long)
+    y : y coordinate(s) (lat)
+
+    return : _x _y : coordinata in transformed projection
+    """
 
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(ds.GetProjection())
-    inProj = Proj(init='epsg:4326')
-    outProj = Proj(srs.ExportToProj4())
-    _x, _y = transform(inProj, outProj, x, y)
+    _x, _y = get_transformer(wkt).transform(x, y)
     return _x, _y
 
 
@@ -486,6 +754,48 @@ def geo_json(data, x, y):
     return output
 
 
+def geo_json_collection(graphs, x, y):
+    """
+    return the process output of several points in GeoJSON format
+
+    graphs : list of JSON graph data, one per point
+    x : x coordinates
+    y : y coordinates
+
+    return : output : GeoJSON FeatureCollection of graph data
+    """
+
+    output = {
+        'type': 'FeatureCollection',
+        'features': [geo_json(data, x_, y_)
+                     for data, x_, y_ in zip(graphs, x, y)]
+    }
+
+    return output
+
+
+def multipoint_2_xy(points):
+    """
+    extract the coordinates of a MultiPoint or of a list of coordinates
+
+    points : GeoJSON MultiPoint (dict or string) or list of [x, y]
+
+    return : x, y : lists of coordinates
+    """
+
+    if isinstance(points, str):
+        points = json.loads(points)
+
+    if isinstance(points, dict):
+        if points.get('type') != 'MultiPoint':
+            raise ValueError('points need to be a MultiPoint')
+        points = points['coordinates']
+
+    x = [float(point[0]) for point in points]
+    y = [float(point[1]) for point in points]
+    return x, y
+
+
 def png(data, coord_x, coord_y, time_step):
     """
     produce a graph
@@ -505,14 +815,6 @@ def png(data, coord_x, coord_y, time_step):
     elif x_size > 18:
         x_size = 18
 
-    params = {'legend.fontsize': '14',
-              'figure.figsize': (x_size, 8.2),
-              'axes.labelsize': '14',
-              'axes.titlesize': '16',
-              'xtick.labelsize': '12',
-              'ytick.labelsize': '12'}
-    plt.rcParams.update(params)
-
     if(coord_y >= 0):
         coord = '(' + str(round(coord_y, 2)) + 'N '
     else:
@@ -526,15 +828,23 @@ def png(data, coord_x, coord_y, time_step):
     y = data['values']
     y2 = data['total_values']
 
-    fig, ax = plt.subplots()
-    plt.bar(x, y, align='edge', width=-0.98)
-    plt.title('Daily Total Precipitation (bars), Cummulative (line)\n' + coord)
-    ax.set_ylabel('mm per day / par jour', color='b')
-    plt.grid(True, which='both', alpha=0.5, linestyle='-')
+    # the figure is not managed by pyplot and the style is given to each
+    # artist (no global rcParams), so graphs can be rendered in threads
+    fig = Figure(figsize=(x_size, 8.2))
+    FigureCanvasAgg(fig)
 
-    ax2 = plt.twinx()
+    ax = fig.subplots()
+    ax.bar(x, y, align='edge', width=-0.98)
+    ax.set_title('Daily Total Precipitation (bars), Cummulative (line)\n' +
+                 coord, fontsize=16)
+    ax.set_ylabel('mm per day / par jour', color='b', fontsize=14)
+    ax.tick_params(labelsize=12)
+    ax.grid(True, which='both', alpha=0.5, linestyle='-')
+
+    ax2 = ax.twinx()
     ax2.plot(x, y2, color='k')
-    ax2.set_ylabel('mm cummulative / cumulatif')
+    ax2.set_ylabel('mm cummulative / cumulatif', fontsize=14)
+    ax2.tick_params(labelsize=12)
     ax2.set_ylim(0, (max(y2) * 1.1))
 
     label = []
@@ -555,15 +865,19 @@ def png(data, coord_x, coord_y, time_step):
         cmpt += 1
 
     ax.xaxis.set_ticks(list(range(1, len(data['dates'])+1)))
-    ax.xaxis.set_ticklabels(label, rotation=90, ha='center')
+    ax.xaxis.set_ticklabels(label, rotation=90, ha='center', fontsize=12)
     ax.margins(x=0)
-    plt.subplots_adjust(bottom=0.2)
+    fig.subplots_adjust(bottom=0.2)
 
     b = BytesIO()
-    plt.savefig(b, bbox_inches='tight', format='png')
+    try:
+        fig.savefig(b, bbox_inches='tight', format='png')
+    finally:
+        fig.clear()
     return b
 
 
+@timed('rdpa-graph', 'total')
 def get_rpda_info(layer, date_end, date_begin, x, y, time_step, format_):
     """
     output information to produce graph about rain
@@ -572,13 +886,25 @@ def get_rpda_info(layer, date_end, date_begin, x, y, time_step, format_):
     layer : layer to search the info in
     date_end : end date
     date_begin : begin date
-    x : x coordinate
-    y : y coordinate
+    x : x coordinate or list of x coordinates
+    y : y coordinate or list of y coordinates
     time_step : time step for the graph in hours
 
-    return : data
+    return : data (FeatureCollection if several points are given)
     """
 
+    multi = np.ndim(x) > 0
+    xs = np.atleast_1d(np.asarray(x, dtype=float))
+    ys = np.atleast_1d(np.asarray(y, dtype=float))
+
+    if xs.shape != ys.shape or xs.size == 0:
+        LOGGER.error('invalid coordinates, x and y need to match')
+        return None
+
+    if multi and format_.lower() == 'png':
+        LOGGER.error('PNG output only supports a single point')
+        return None
+
     try:
 
         date_begin = valid_dates(date_begin)
@@ -589,37 +915,190 @@ def get_rpda_info(layer, date_end, date_begin, x, y, time_step, format_):
         LOGGER.error(msg)
         return None
 
-    # TODO: use env variable for ES connection
-    es = Elasticsearch(['localhost:9200'])
-    res, nb_res = query_es(es, ES_INDEX, date_end, date_begin, layer)
-
-    if res is not None:
-        if nb_res > 0:
-            file1 = res[0]['_source']['properties']['filepath']
-            cumul = _24_or_6(file1)
-            try:
-                if (time_step % cumul) == 0:
-                    _x, _y = transform_coord(file1, x, y)
-                    values = get_values(res, _x, _y, cumul)
-                    data = get_graph_arrays(values, time_step)
+    source = get_rpda_source(layer, date_end, date_begin, time_step)
+    if source is None:
+        return None
 
-                    if format_.lower() == 'geojson':
-                        output = geo_json(data, x, y)
-                    else:
-                        output = png(data, x, y, time_step)
+    # the output is looked up before the documents are listed and any
+    # raster is read, the fingerprint of the source files changes when
+    # new or reprocessed files come in
+    key = cache_key('rdpa-graph', layer, date_end, date_begin, xs.tolist(),
+                    ys.tolist(), multi, time_step, format_.lower(),
+                    source_fingerprint(source))
+    output = OUTPUTS.get(key)
+    if output is not None:
+        return output
+
+    values = read_rpda_values(source, xs, ys)
+    if values is None:
+        return None
+    elif not values['dates']:
+        LOGGER.error('no data found')
+        return None
 
-                    return output
-                else:
-                    LOGGER.error('invalid time step')
-            except ZeroDivisionError as error:
-                msg = 'layer error :  {}' .format(error)
-                LOGGER.error(msg)
-        else:
-            LOGGER.error('no data found')
+    # every point is binned at once, lists are only built for the output
+    with timed('rdpa-graph', 'bin'):
+        step_values, total_values, dates = graph_arrays(values['values'],
+                                                        values['dates'],
+                                                        time_step)
+        dates = format_dates(dates, time_step)
+    graphs = [{
+        'values': step_values[:, i].tolist(),
+        'total_values': total_values[:, i].tolist(),
+        'dates': list(dates)
+    } for i in range(xs.size)]
+
+    if format_.lower() == 'geojson':
+        with timed('rdpa-graph', 'encode'):
+            if multi:
+                output = geo_json_collection(graphs, xs.tolist(),
+                                             ys.tolist())
+            else:
+                output = geo_json(graphs[0], x, y)
     else:
+        with timed('rdpa-graph', 'render'):
+            output = render(png, graphs[0], x, y, time_step)
+
+    OUTPUTS.set(key, output)
+    return output
+
+
+def get_rpda_source(layer, date_end, date_begin, time_step):
+    """
+    find where the rdpa values are read from, the rdpa cube of the layer
+    if it covers the dates, otherwise the files found by ES; only the
+    last document and the number of documents are searched, the
+    documents are streamed when the values are read
+
+    layer : layer to search the info in
+    date_end : end date
+    date_begin : begin date
+    time_step : time step for the graph in hours
+
+    return : source : dict with the cube, or the ES search parameters,
+             last document, number of documents, accumulation and time
+             filter; None if not found
+    """
+
+    cube = get_cube(layer)
+    if cube is not None and cube.covers(date_begin, date_end):
+        if (time_step % cube.cumul) != 0:
+            LOGGER.error('invalid time step')
+            return None
+        return {'cube': cube, 'date_begin': date_begin,
+                'date_end': date_end}
+
+    try:
+        with timed('rdpa-graph', 'lookup'):
+            last, total = query_es_last(get_es(), ES_INDEX, date_end,
+                                        date_begin, layer)
+
+    except exceptions.ElasticsearchException as error:
+        msg = 'ES search error: {}' .format(error)
+        LOGGER.error(msg)
         LOGGER.error('failed to extract data')
+        return None
 
-    return None
+    if last is None:
+        LOGGER.error('no data found')
+        return None
+
+    file1 = last['filepath']
+    cumul = _24_or_6(file1)
+    if cumul == 0 or (time_step % cumul) != 0:
+        LOGGER.error('invalid time step')
+        return None
+
+    time_ = None
+    if cumul == 24:      # use half of the documents
+        date_, time_ = last['forecast_hour_datetime'].split('T')
+
+    return {'layer': layer, 'date_begin': date_begin, 'date_end': date_end,
+            'last': last, 'total': total, 'cumul': cumul, 'time': time_,
+            'file': file1}
+
+
+def source_fingerprint(source):
+    """
+    find a fingerprint of the files of a rdpa source, used in the output
+    cache key so new or reprocessed files aren't served stale; it is
+    computed without listing the documents or reading the rasters
+
+    source : rdpa source (see get_rpda_source)
+
+    return : fingerprint : list of the cube file identities, or of the
+             last document, its file identity and the number of
+             documents
+    """
+
+    if 'cube' in source:
+        cube = source['cube']
+        return [file_identity(cube.index_path),
+                file_identity(cube.data_path)]
+
+    return [source['last']['filepath'],
+            source['last']['forecast_hour_datetime'],
+            file_identity(source['file']), source['total']]
+
+
+def read_rpda_values(source, x, y):
+    """
+    read the raw rdpa values at (x, y) from a rdpa source, the ES
+    documents are sampled as they are streamed
+
+    source : rdpa source (see get_rpda_source)
+    x : x coordinates
+    y : y coordinates
+
+    return : (x, y) raster values and dates, None on ES error
+    """
+
+    with timed('rdpa-graph', 'read'):
+        if 'cube' in source:
+            cube = source['cube']
+            _x, _y = transform_wkt(cube.projection, x, y)
+            cols, rows = xy_2_pixel(cube.geotransform, _x, _y)
+            return cube.get_values(cols, rows, source['date_begin'],
+                                   source['date_end'])
+
+        _x, _y = transform_coord(source['file'], x, y)
+        try:
+            # only the file paths and dates are kept
+            with closing(query_es(get_es(), ES_INDEX, source['date_end'],
+                                  source['date_begin'], source['layer'],
+                                  source['time'])) as res:
+                return get_values(res, _x, _y, source['cumul'],
+                                  time_=source['time'])
+
+        except exceptions.ElasticsearchException as error:
+            msg = 'ES search error: {}' .format(error)
+            LOGGER.error(msg)
+            LOGGER.error('failed to extract data')
+            return None
+
+
+def get_rpda_output(layer, date_end, date_begin, x, y, time_step, format_):
+    """
+    produce the rdpa graph process output
+
+    param layer : layer name
+    param date_end : end date of the graph
+    param date_begin : begin date of the graph
+    param x : x coordinate(s)
+    param y : y coordinate(s)
+    param time_step : graph time step
+    param format_ : output format
+
+    return : output : GeoJSON dict or PNG bytes (empty when no data)
+    """
+
+    output = get_rpda_info(layer, date_end, date_begin, x, y, time_step,
+                           format_)
+    if format_.lower() == 'png':
+        if output is not None:
+            return output.getvalue()
+        return BytesIO().getvalue()
+    return output
 
 
 @click.group('execute')
@@ -632,12 +1111,21 @@ def rdpa_graph_execute():
 @click.option('--layer', help='layer name', type=str)
 @click.option('--date_end', help='end date of the graph', type=str)
 @click.option('--date_begin', help='end date of the graph', type=str)
-@click.option('--x', help='x coordinate', type=float)
-@click.option('--y', help='y coordinate', type=float)
+@click.option('--x', help='x coordinate (repeat for several points)',
+              type=float, multiple=True)
+@click.option('--y', help='y coordinate (repeat for several points)',
+              type=float, multiple=True)
 @click.option('--time_step', help='graph time step', type=int, default=0)
 @click.option('--format', 'format_', type=click.Choice(['GeoJSON', 'PNG']),
               default='GeoJSON', help='output format')
 def cli(ctx, layer, date_end, date_begin, x, y, time_step, format_):
+    if len(x) == 1 and len(y) == 1:
+        x = x[0]
+        y = y[0]
+    else:
+        x = list(x)
+        y = list(y)
+
     output = get_rpda_info(layer, date_end, date_begin, x, y, time_step,
                            format_)
     if format_.lower() == 'png':
@@ -668,11 +1156,17 @@ try:
             BaseProcessor.__init__(self, provider_def, PROCESS_METADATA)
 
         def execute(self, data):
+            try:
+                if data.get('job-id'):
+                    return get_job_output(data['job-id'])
+            except ValueError as error:
+                msg = 'Process execution error: {}'.format(error)
+                LOGGER.error(msg)
+                raise ProcessorExecuteError(msg)
+
             layer = data['layer']
             date_end = data['date_end']
             date_begin = data['date_begin']
-            x = data['x']
-            y = data['y']
             time_step = data['time_step']
             format_ = data['format']
 
@@ -682,22 +1176,20 @@ try:
                 raise ValueError(msg)
 
             try:
-                output = get_rpda_info(layer, date_end, date_begin, x, y,
-                                       time_step, format_)
+                if 'points' in data:
+                    x, y = multipoint_2_xy(data['points'])
+                else:
+                    x = data['x']
+                    y = data['y']
 
-            except ValueError as error:
+                return run_job(data.get('mode'), get_rpda_output, layer,
+                               date_end, date_begin, x, y, time_step, format_)
+
+            except (JobQueueFull, RenderError, ValueError) as error:
                 msg = 'Process execution error: {}'.format(error)
                 LOGGER.error(msg)
                 raise ProcessorExecuteError(msg)
 
-            if format_.lower() == 'png':
-                if output is not None:
-                    return output.getvalue()
-                else:
-                    return BytesIO().getvalue()
-            else:
-                return output
-
         def __repr__(self):
             return '<RdpaGraphProcessor> {}'.format(self.name)
 
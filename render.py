@@ -0,0 +1,160 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# processes rendering the PNG outputs (0 to render in the request thread)
+RENDER_WORKERS = int(os.environ.get('MSC_PYGEOAPI_RENDER_WORKERS',
+                                    min(4, os.cpu_count() or 1)))
+# seconds a render request waits for its job (queue included), the workers
+# are replaced after it
+RENDER_TIMEOUT = float(os.environ.get('MSC_PYGEOAPI_RENDER_TIMEOUT', 60))
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class RenderError(Exception):
+    """the render workers failed, the output could not be rendered"""
+    pass
+
+
+def warm_up():
+    """
+    initialize a render worker, matplotlib and cartopy are imported and
+    the font cache is built before the first job
+    """
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    import msc_pygeoapi.process.weather.generate_vigilance  # noqa
+    import msc_pygeoapi.process.weather.rdpa_graph  # noqa
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    fig.text(0.5, 0.5, 'Émis/Issued')
+    fig.canvas.draw()
+
+
+def ping():
+    """no-op job used to start the render workers"""
+
+    return os.getpid()
+
+
+def get_pool():
+    """
+    return the render worker pool, it is created (and its workers
+    started) on first use
+
+    return : pool : ProcessPoolExecutor
+    """
+
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is None:
+            # spawn: forking a multi-threaded server is not safe
+            context = multiprocessing.get_context('spawn')
+            _POOL = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                        mp_context=context,
+                                        initializer=warm_up)
+            for _ in range(RENDER_WORKERS):
+                _POOL.submit(ping)
+
+        return _POOL
+
+
+def reset_pool(pool=None, terminate=False):
+    """
+    shut down the render worker pool, a new one is created when needed
+
+    param pool : only shut down the pool if it is still this one (so a
+                 pool another request already replaced is kept)
+    param terminate : also kill the workers (ex: a hung worker)
+    """
+
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is None or pool not in (None, _POOL):
+            return
+        pool, _POOL = _POOL, None
+
+    # the executor has no public way to stop a running job
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    if terminate:
+        for process in processes:
+            process.terminate()
+
+
+def render(func, *args):
+    """
+    run a render job on the render worker pool, only the job arguments
+    (NumPy data and metadata) and the result are sent between processes;
+    if a worker dies the pool is replaced and the job is retried once,
+    jobs are never rendered in the request thread of a pooled server;
+    a job running longer than RENDER_TIMEOUT fails and its workers are
+    replaced
+
+    func : module level render function (ex: add_basemap)
+    args : arguments of func
+
+    return : result of func (raise RenderError if the job timed out or
+             failed on a fresh pool too)
+    """
+
+    if RENDER_WORKERS <= 0:
+        return func(*args)
+
+    for attempt in range(2):
+        pool = get_pool()
+        try:
+            return pool.submit(func, *args).result(timeout=RENDER_TIMEOUT)
+        except TimeoutError:
+            LOGGER.error('Render job timed out after {}s'.format(
+                RENDER_TIMEOUT))
+            reset_pool(pool, terminate=True)
+            raise RenderError('render timed out, retry later')
+        except BrokenProcessPool as error:
+            msg = 'Render worker failed (attempt {}): {}'.format(
+                attempt + 1, error)
+            LOGGER.error(msg)
+            reset_pool(pool)
+
+    raise RenderError('render workers failed, retry later')
@@ -0,0 +1,345 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from datetime import datetime, timedelta
+import os
+
+import numpy as np
+import pytest
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# GEPS global 0.5 degree grid
+GEPS_SIZE = (720, 361)
+GEPS_GEOTRANSFORM = (-180.25, 0.5, 0, 90.25, 0, -0.5)
+GEPS_LAYERS = ['GEPS.DIAG.24_PRMM.ERGE10', 'GEPS.DIAG.24_PRMM.ERGE25',
+               'GEPS.DIAG.24_PRMM.ERGE50']
+# RDPA 10 km polar stereographic grid
+RDPA_SIZE = (935, 824)
+RDPA_GEOTRANSFORM = (-4556441.403315245, 10000, 0,
+                     920682.1411659503, 0, -10000)
+RDPA_PROJ4 = ('+proj=stere +lat_0=90 +lat_ts=60 +lon_0=249 +x_0=0 +y_0=0 '
+              '+R=6371229 +units=m +no_defs')
+RDPA_LAYER = 'RDPA.24F_PR'
+# days of RDPA files of the fixtures
+RDPA_DAYS = 30
+# formats of the fixture rasters (GRIB is the production format)
+FIXTURE_EXTENSIONS = {'GRIB': 'grib2', 'GTiff': 'tif'}
+
+
+class FakeES(object):
+    """
+    in-process stand-in of the tile-index ES search, it answers the
+    term, terms, prefix and range filters, sorts and search_after pages used by
+    the weather processes
+    """
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.searches = 0
+
+    def add(self, properties):
+        self.docs.append({'_source': {'properties': properties}})
+
+    def open_point_in_time(self, index=None, keep_alive=None):
+        return {'id': 'fake-pit'}
+
+    def close_point_in_time(self, body=None):
+        return {'succeeded': True}
+
+    @staticmethod
+    def _value(doc, field):
+        value = doc['_source']
+        for key in field.replace('.raw', '').split('.'):
+            value = value.get(key)
+            if value is None:
+                break
+        return value
+
+    def _match(self, query, doc):
+        if 'bool' in query:
+            clauses = []
+            for occur in ('must', 'filter'):
+                clause = query['bool'].get(occur, [])
+                clauses.extend(clause if isinstance(clause, list)
+                               else [clause])
+            return all(self._match(clause, doc) for clause in clauses)
+
+        if 'term' in query:
+            (field, value), = query['term'].items()
+            return self._value(doc, field) == value
+
+        if 'terms' in query:
+            (field, values), = query['terms'].items()
+            return self._value(doc, field) in values
+
+        if 'prefix' in query:
+            (field, prefix), = query['prefix'].items()
+            value = self._value(doc, field)
+            return value is not None and value.startswith(prefix)
+
+        if 'range' in query:
+            (field, bounds), = query['range'].items()
+            value = self._value(doc, field)
+            if value is None:
+                return False
+            return (value >= bounds.get('gte', value) and
+                    value <= bounds.get('lte', value))
+
+        raise ValueError('unsupported query: {}'.format(query))
+
+    def search(self, index=None, body=None, **kwargs):
+        self.searches += 1
+
+        hits = [doc for doc in self.docs
+                if self._match(body.get('query', {'bool': {}}), doc)]
+
+        sort = [next(iter(item.items())) for item in body.get('sort', [])]
+        for name, order in reversed(sort):
+            hits.sort(key=lambda doc: self._value(doc, name),
+                      reverse=(order == 'desc'))
+        hits = [dict(doc, sort=[self._value(doc, name)
+                                for name, _ in sort]) for doc in hits]
+
+        if 'search_after' in body:
+            after = body['search_after']
+            hits = [doc for doc in hits
+                    if (doc['sort'] < after if sort[0][1] == 'desc'
+                        else doc['sort'] > after)]
+
+        res = {
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'hits': hits[:body.get('size', 10)]
+            }
+        }
+        if 'pit' in body:
+            res['pit_id'] = body['pit']['id']
+        return res
+
+
+def field(shape, seed, scale=100):
+    """
+    create a smooth synthetic field, like a probability or accumulation
+
+    param shape : (rows, cols)
+    param seed : random seed
+    param scale : maximum value
+
+    return : array : float32 array
+    """
+
+    rng = np.random.default_rng(seed)
+    rows = np.linspace(0, 1, shape[0])[:, np.newaxis]
+    cols = np.linspace(0, 1, shape[1])[np.newaxis, :]
+    array = np.zeros(shape)
+    for _ in range(6):
+        fx, fy = rng.uniform(1, 12, 2)
+        px, py = rng.uniform(0, 6, 2)
+        array += (np.sin(fx * np.pi * cols + px) *
+                  np.sin(fy * np.pi * rows + py))
+    array -= array.min()
+    return (array * scale / array.max()).astype(np.float32)
+
+
+def write_raster(path, arrays, geotransform, srs, driver):
+    """
+    write a raster fixture
+
+    param path : file path
+    param arrays : list of band arrays
+    param geotransform : geotransform
+    param srs : osr spatial reference
+    param driver : GDAL driver name (GRIB or GTiff)
+
+    return : path : file path
+    """
+
+    from osgeo import gdal
+
+    rows, cols = arrays[0].shape
+    ds = gdal.GetDriverByName('MEM').Create('', cols, rows, len(arrays),
+                                            gdal.GDT_Float32)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(srs.ExportToWkt())
+    for index, array in enumerate(arrays):
+        ds.GetRasterBand(index + 1).WriteArray(array)
+
+    gdal.GetDriverByName(driver).CreateCopy(path, ds)
+    ds = None
+    return path
+
+
+@pytest.fixture(scope='session', params=sorted(FIXTURE_EXTENSIONS))
+def weather_data(request, tmp_path_factory):
+    """
+    GEPS and RDPA rasters and their tile-index documents, in each
+    fixture format
+
+    GEPS : one raster of the 3 layers bands for the forecast hour, read
+           through a VRT like the tile-index files
+    RDPA : one 24h accumulation raster a day, at 12Z
+
+    return : data : dict of the FakeES, the request parameters and the
+             RDPA files
+    """
+
+    from osgeo import gdal, osr
+
+    gdal.UseExceptions()
+    driver = request.param
+    ext = FIXTURE_EXTENSIONS[driver]
+    directory = str(tmp_path_factory.mktemp('weather-{}'.format(ext)))
+    es = FakeES()
+
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    mr = datetime(2020, 6, 1, 0)
+    fh = mr + timedelta(hours=72)
+
+    raster = write_raster(
+        os.path.join(directory, 'geps.{}'.format(ext)),
+        [field(GEPS_SIZE[::-1], seed) for seed in range(3)],
+        GEPS_GEOTRANSFORM, wgs84, driver)
+    vrt = os.path.join(directory, 'geps.vrt')
+    gdal.BuildVRT(vrt, [raster])
+
+    for band, layer in enumerate(GEPS_LAYERS, 1):
+        es.add({
+            'layer': layer,
+            'filepath': 'vrt://{}?bands={}'.format(vrt, band),
+            'weather_variable': 'PRMM',
+            'forecast_hour_datetime': fh.strftime(DATE_FORMAT),
+            'reference_datetime': mr.strftime(DATE_FORMAT)
+        })
+
+    stere = osr.SpatialReference()
+    stere.ImportFromProj4(RDPA_PROJ4)
+    os.makedirs(os.path.join(directory, 'rdpa', '24'))
+    date_end = datetime(2020, 6, 30, 12)
+    files = []
+    for day in reversed(range(RDPA_DAYS)):
+        date = date_end - timedelta(days=day)
+        path = os.path.join(directory, 'rdpa', '24', '{}_RDPA_24.{}'.format(
+            date.strftime('%Y%m%d%H'), ext))
+        write_raster(path, [field(RDPA_SIZE[::-1], day, 50)],
+                     RDPA_GEOTRANSFORM, stere, driver)
+        es.add({
+            'layer': RDPA_LAYER,
+            'filepath': path,
+            'forecast_hour_datetime': date.strftime(DATE_FORMAT)
+        })
+        files.append((date.strftime(DATE_FORMAT), path))
+
+    return {
+        'es': es,
+        'directory': directory,
+        'layers': GEPS_LAYERS,
+        'mr': mr,
+        'fh': fh,
+        'path': vrt,
+        'layer': RDPA_LAYER,
+        'date_end': date_end,
+        'rdpa_files': files
+    }
+
+
+@pytest.fixture(scope='session')
+def rdpa_cube_dir(weather_data):
+    """directory of the rdpa cube of the RDPA fixtures"""
+
+    from msc_pygeoapi.process.weather.rdpa_cube import append_file
+
+    directory = os.path.join(weather_data['directory'], 'cube')
+    os.makedirs(directory)
+    for date, path in weather_data['rdpa_files']:
+        append_file(directory, RDPA_LAYER, path, date)
+    return directory
+
+
+@pytest.fixture
+def weather(weather_data, monkeypatch):
+    """
+    run the weather processes against the fixtures: the FakeES answers
+    the searches, renders are done inline and the outputs are only
+    cached in memory
+    """
+
+    from msc_pygeoapi.process.weather import render, rdpa_cube
+    from msc_pygeoapi.process.weather.cache import OUTPUTS
+    from msc_pygeoapi.process.weather.util import DATASETS, set_es
+
+    monkeypatch.setattr(render, 'RENDER_WORKERS', 0)
+    monkeypatch.setattr(OUTPUTS, 'directory', None)
+    monkeypatch.setattr(rdpa_cube, 'CUBE_DIR', None)
+
+    previous = set_es(weather_data['es'])
+    yield weather_data
+    set_es(previous)
+    _clear_caches()
+    DATASETS.clear()
+
+
+def _clear_caches():
+    """forget the manifests and outputs, so every run is computed"""
+
+    from msc_pygeoapi.process.weather import generate_vigilance
+    from msc_pygeoapi.process.weather.cache import OUTPUTS
+
+    generate_vigilance.MANIFESTS.clear()
+    OUTPUTS.clear()
+
+
+@pytest.fixture
+def clear_caches():
+    """function forgetting the manifests and outputs (benchmark setup)"""
+
+    return _clear_caches
+
+
+@pytest.fixture
+def weather_cube(weather, rdpa_cube_dir, monkeypatch):
+    """read the rdpa values from the cube of the RDPA fixtures"""
+
+    from msc_pygeoapi.process.weather import rdpa_cube
+
+    monkeypatch.setattr(rdpa_cube, 'CUBE_DIR', rdpa_cube_dir)
+    return weather
+
+
+@pytest.fixture
+def fake_es():
+    """an empty FakeES answering the searches of the weather processes"""
+
+    from msc_pygeoapi.process.weather.util import set_es
+
+    es = FakeES()
+    previous = set_es(es)
+    yield es
+    set_es(previous)
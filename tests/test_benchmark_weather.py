@@ -0,0 +1,322 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+"""
+benchmarks of the stages of the weather processes, run with
+pytest-benchmark on synthetic GEPS and RDPA rasters (GRIB and GeoTIFF,
+see conftest.py):
+
+    pytest tests --benchmark-only
+
+the peak memory (Python and NumPy allocations) of a run of each stage
+is kept in the benchmark extra_info
+"""
+
+from datetime import timedelta
+import tracemalloc
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('pytest_benchmark')
+
+from msc_pygeoapi.process.weather import generate_vigilance as gv  # noqa
+from msc_pygeoapi.process.weather import rdpa_graph as rg  # noqa
+from msc_pygeoapi.process.weather.util import DATASETS  # noqa
+
+BBOXES = {
+    'canada': gv.CANADA_BBOX,
+    'quebec': '-80, 44, -64, 52'
+}
+TILES = ['3/2/2', '6/18/22']
+# one point, and points spread over Canada (sparse pixel reads)
+POINTS = {
+    'point': ([-75.7], [45.4]),
+    'spread': (np.linspace(-130, -60, 20).tolist(),
+               np.linspace(45, 70, 20).tolist())
+}
+DAYS = [7, 30]
+TIME_STEP = 48
+ROUNDS = 5
+
+
+def run(benchmark, func, *args, setup=None):
+    """
+    benchmark a stage and record its peak memory, the timed runs are
+    done without tracemalloc, the peak is measured on an extra run
+
+    param benchmark : pytest-benchmark fixture
+    param func : function running the stage
+    param args : arguments of func
+    param setup : function called before every run (not timed)
+
+    return : result of func
+    """
+
+    if setup is None:
+        result = benchmark(func, *args)
+    else:
+        result = benchmark.pedantic(func, args, setup=setup, rounds=ROUNDS)
+        setup()
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        benchmark.extra_info['peak_memory'] = \
+            tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return result
+
+
+def vigilance_request(weather, bbox):
+    """
+    find the source and the snapped bbox of a vigilance request, like
+    generate_vigilance does
+
+    return : path, bands, bbox, variable, tresholds, model
+    """
+
+    files, variables = gv.get_files(weather['layers'], weather['fh'],
+                                    weather['mr'])
+    path, bands = gv.get_bands(files)
+    bands.sort()
+    sufix, model, tresholds = gv.valid_layer(weather['layers'])
+    bbox = gv.snap_bbox(DATASETS.info(path).geotransform,
+                        gv.convert_bbox(bbox.split(',')))
+    return path, bands, bbox, variables[0], tresholds, model
+
+
+def read_tiles(path, bands, bbox):
+    """
+    read the bands of a vigilance window by tile, like get_new_array
+
+    return : tiles : list of (tile window, band arrays)
+    """
+
+    with DATASETS.open(path) as ds:
+        window = gv.bbox_window(ds.GetGeoTransform(), bbox)
+        block_size = ds.GetRasterBand(bands[0]).GetBlockSize()
+        tiles = []
+        for tile in gv.get_tiles(window, block_size,
+                                 gv.VIGILANCE_TILE_SIZE):
+            col, row, ncols, nrows = tile
+            tiles.append((tile, [
+                ds.GetRasterBand(band).ReadAsArray(
+                    col, row, ncols, nrows).astype(np.float32)
+                for band in bands]))
+    return window, tiles
+
+
+def classify_tiles(window, tiles):
+    """
+    classify tiles read by read_tiles, like classify_tile
+
+    return : max_array : vigilance array
+    """
+
+    max_array = np.zeros((window[3], window[2]), dtype=np.uint8)
+    for (col, row, ncols, nrows), arrays in tiles:
+        out = max_array[row - window[1]:row - window[1] + nrows,
+                        col - window[0]:col - window[0] + ncols]
+        level = np.empty((nrows, ncols), dtype=np.uint8)
+        mask = np.empty((nrows, ncols), dtype=bool)
+        for array, thresholds in zip(arrays, gv.VIGILANCE_THRESHOLDS):
+            gv.classify(array, thresholds, out, level, mask)
+    return max_array
+
+
+def rdpa_dates(weather, days):
+    """return : date_end, date_begin of a graph of days days"""
+
+    date_end = weather['date_end']
+    date_begin = date_end - timedelta(days=days - 1)
+    return (date_end.strftime(rg.DATE_FORMAT),
+            date_begin.strftime(rg.DATE_FORMAT))
+
+
+def rdpa_graph(weather, days, points='point'):
+    """
+    read and bin the rdpa values of a graph, like get_rpda_info
+
+    return : graph : values, total values and dates of the first point
+    """
+
+    date_end, date_begin = rdpa_dates(weather, days)
+    source = rg.get_rpda_source(weather['layer'], date_end, date_begin,
+                                TIME_STEP)
+    xs, ys = (np.array(values, dtype=float) for values in POINTS[points])
+    values = rg.read_rpda_values(source, xs, ys)
+    step_values, total_values, dates = rg.graph_arrays(
+        values['values'], values['dates'], TIME_STEP)
+    return {
+        'values': step_values[:, 0].tolist(),
+        'total_values': total_values[:, 0].tolist(),
+        'dates': rg.format_dates(dates, TIME_STEP)
+    }
+
+
+def test_vigilance_lookup(benchmark, weather, clear_caches):
+    files, variables = run(benchmark, gv.get_files, weather['layers'],
+                           weather['fh'], weather['mr'],
+                           setup=clear_caches)
+    assert len(files) == 3
+
+
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_vigilance_read(benchmark, weather, bbox):
+    path, bands, bbox = vigilance_request(weather, BBOXES[bbox])[:3]
+    window, tiles = run(benchmark, read_tiles, path, bands, bbox)
+    assert sum(tile[2] * tile[3] for tile, _ in tiles) == \
+        window[2] * window[3]
+
+
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_vigilance_classify(benchmark, weather, bbox):
+    path, bands, bbox = vigilance_request(weather, BBOXES[bbox])[:3]
+    window, tiles = read_tiles(path, bands, bbox)
+    vigi_data = run(benchmark, classify_tiles, window, tiles)
+    np.testing.assert_array_equal(vigi_data,
+                                  gv.get_new_array(path, bands, bbox))
+
+
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_vigilance_read_classify(benchmark, weather, bbox):
+    path, bands, bbox = vigilance_request(weather, BBOXES[bbox])[:3]
+    vigi_data = run(benchmark, gv.get_new_array, path, bands, bbox)
+    assert vigi_data.max() <= 3
+
+
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_vigilance_render(benchmark, weather, bbox):
+    path, bands, bbox, variable, tresholds, model = vigilance_request(
+        weather, BBOXES[bbox])
+    vigi_data = gv.get_new_array(path, bands, bbox)
+    textstr = gv.get_data_text(variable, tresholds, weather['mr'], model,
+                               weather['fh'])
+    output = run(benchmark, gv.add_basemap, vigi_data, bbox, textstr)
+    assert output.getvalue().startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('format_', ['geotiff', 'geopng'])
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_vigilance_encode(benchmark, weather, bbox, format_):
+    path, bands, bbox = vigilance_request(weather, BBOXES[bbox])[:3]
+    vigi_data = gv.get_new_array(path, bands, bbox)
+    if format_ == 'geotiff':
+        output = run(benchmark, gv.get_geotiff, vigi_data, bbox, path)
+    else:
+        output = run(benchmark, gv.get_geopng, vigi_data, bbox)
+    assert output is not None
+
+
+@pytest.mark.parametrize('format_', ['png', 'geotiff', 'geopng'])
+@pytest.mark.parametrize('bbox', sorted(BBOXES))
+def test_generate_vigilance(benchmark, weather, clear_caches, bbox,
+                            format_):
+    output = run(benchmark, gv.generate_vigilance, weather['layers'],
+                 weather['fh'], weather['mr'], BBOXES[bbox].split(','),
+                 format_, setup=clear_caches)
+    assert output is not None
+
+
+@pytest.mark.parametrize('tile', TILES)
+def test_vigilance_tile(benchmark, weather, clear_caches, tile):
+    output = run(benchmark, gv.get_tile, weather['layers'], weather['fh'],
+                 weather['mr'], tile, setup=clear_caches)
+    assert output.getvalue().startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('cube', [False, True], ids=['files', 'cube'])
+@pytest.mark.parametrize('days', DAYS)
+def test_rdpa_lookup(benchmark, weather, request, days, cube):
+    if cube:
+        request.getfixturevalue('weather_cube')
+    date_end, date_begin = rdpa_dates(weather, days)
+    source = run(benchmark, rg.get_rpda_source, weather['layer'], date_end,
+                 date_begin, TIME_STEP)
+    assert ('cube' in source) == cube
+
+
+@pytest.mark.parametrize('cube', [False, True], ids=['files', 'cube'])
+@pytest.mark.parametrize('points', sorted(POINTS))
+@pytest.mark.parametrize('days', DAYS)
+def test_rdpa_read(benchmark, weather, request, days, points, cube):
+    # the files are listed by the streamed ES search while they are read
+    if cube:
+        request.getfixturevalue('weather_cube')
+    date_end, date_begin = rdpa_dates(weather, days)
+    source = rg.get_rpda_source(weather['layer'], date_end, date_begin,
+                                TIME_STEP)
+    xs, ys = (np.array(values, dtype=float) for values in POINTS[points])
+    values = run(benchmark, rg.read_rpda_values, source, xs, ys)
+    assert values['values'].shape == (days, xs.size)
+
+
+@pytest.mark.parametrize('days', DAYS)
+def test_rdpa_bin(benchmark, weather, days):
+    date_end, date_begin = rdpa_dates(weather, days)
+    source = rg.get_rpda_source(weather['layer'], date_end, date_begin,
+                                TIME_STEP)
+    xs, ys = (np.array(values, dtype=float) for values in POINTS['spread'])
+    values = rg.read_rpda_values(source, xs, ys)
+    step_values, total_values, dates = run(
+        benchmark, rg.graph_arrays, values['values'], values['dates'],
+        TIME_STEP)
+    np.testing.assert_allclose(total_values[-1], values['values'].sum(0),
+                               rtol=1e-5)
+
+
+@pytest.mark.parametrize('days', DAYS)
+def test_rdpa_encode(benchmark, weather, days):
+    graph = rdpa_graph(weather, days)
+    x, y = POINTS['point']
+    output = run(benchmark, rg.geo_json, graph, x[0], y[0])
+    assert output['properties']['values'] == graph['values']
+
+
+@pytest.mark.parametrize('days', DAYS)
+def test_rdpa_render(benchmark, weather, days):
+    graph = rdpa_graph(weather, days)
+    x, y = POINTS['point']
+    output = run(benchmark, rg.png, graph, x[0], y[0], TIME_STEP)
+    assert output.getvalue().startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('format_', ['GeoJSON', 'PNG'])
+@pytest.mark.parametrize('days', DAYS)
+def test_get_rpda_info(benchmark, weather, clear_caches, days, format_):
+    date_end, date_begin = rdpa_dates(weather, days)
+    x, y = POINTS['point']
+    output = run(benchmark, rg.get_rpda_info, weather['layer'], date_end,
+                 date_begin, x[0], y[0], TIME_STEP, format_,
+                 setup=clear_caches)
+    assert output is not None
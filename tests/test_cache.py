@@ -0,0 +1,150 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from io import BytesIO
+import os
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from msc_pygeoapi.process.weather.cache import (cache_key,  # noqa
+                                                CACHE_LOW_WATER,
+                                                OutputCache)
+from msc_pygeoapi.process.weather.util import (decode_output,  # noqa
+                                               encode_output)
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+OUTPUTS = {
+    'bytes': PNG,
+    'buffer': BytesIO(PNG),
+    'json': {'type': 'Feature', 'properties': {'values': [1.5, 2.0]}},
+    'geopng': {'png': PNG, 'bbox': [-140, 35, -44, 83], 'legend': 'x'}
+}
+
+
+def same_output(a, b):
+    if isinstance(a, BytesIO):
+        return isinstance(b, BytesIO) and a.getvalue() == b.getvalue()
+    return type(a) is type(b) and a == b
+
+
+@pytest.mark.parametrize('name', sorted(OUTPUTS))
+def test_encode_decode_round_trip(name):
+    content, header = encode_output(OUTPUTS[name])
+    assert isinstance(content, bytes)
+    assert same_output(decode_output(content, header), OUTPUTS[name])
+
+
+def test_encode_mimetype():
+    assert encode_output(PNG)[1]['mimetype'] == 'image/png'
+    assert encode_output(b'II*\x00rest')[1]['mimetype'] == 'image/tiff'
+    assert encode_output(OUTPUTS['json'])[1]['mimetype'] == \
+        'application/json'
+
+
+def test_encode_rejects_other_types():
+    with pytest.raises(TypeError):
+        encode_output(object())
+
+
+def test_cache_key():
+    assert cache_key('a', [1, 2], {'b': 1}) == cache_key('a', [1, 2],
+                                                         {'b': 1})
+    assert cache_key('a', [1, 2]) != cache_key('a', [2, 1])
+
+
+@pytest.mark.parametrize('name', sorted(OUTPUTS))
+def test_memory_round_trip(name):
+    cache = OutputCache(memory_size=1024 * 1024, directory=None)
+    cache.set('key', OUTPUTS[name])
+    assert same_output(cache.get('key'), OUTPUTS[name])
+    assert cache.get('other') is None
+
+
+def test_memory_eviction():
+    cache = OutputCache(memory_size=3 * len(PNG), directory=None)
+    for index in range(4):
+        cache.set(str(index), PNG)
+    assert cache.get('0') is None
+    assert all(cache.get(str(index)) == PNG for index in range(1, 4))
+
+
+@pytest.mark.parametrize('name', sorted(OUTPUTS))
+def test_disk_round_trip(name, tmp_path):
+    cache = OutputCache(memory_size=0, directory=str(tmp_path))
+    cache.set('ab' * 32, OUTPUTS[name])
+
+    # the disk tier is shared with the other processes
+    other = OutputCache(memory_size=0, directory=str(tmp_path))
+    assert 'ab' * 32 in other
+    assert same_output(other.get('ab' * 32), OUTPUTS[name])
+
+
+def disk_files(directory):
+    return {name: os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(directory) for name in names}
+
+
+def entry_size(directory):
+    cache = OutputCache(memory_size=0, directory=directory)
+    cache.set('size', PNG)
+    size = os.path.getsize(cache._path('size'))
+    cache.pop('size')
+    return size
+
+
+def test_disk_eviction_low_water(tmp_path):
+    size = entry_size(str(tmp_path))
+    cache = OutputCache(memory_size=0, directory=str(tmp_path),
+                        disk_size=10 * size)
+    keys = ['{:064x}'.format(index) for index in range(11)]
+    for index, key in enumerate(keys[:10]):
+        cache.set(key, PNG)
+        os.utime(cache._path(key), (index, index))
+    assert all(key in cache for key in keys[:10])
+
+    cache.set(keys[10], PNG)
+    files = disk_files(str(tmp_path))
+    assert sum(files.values()) <= 10 * size * CACHE_LOW_WATER
+    # the least recently used entries are evicted first
+    assert keys[0] not in cache and keys[1] not in cache
+    assert all(key in cache for key in keys[2:])
+
+
+def test_disk_overwrite_accounting(tmp_path):
+    size = entry_size(str(tmp_path))
+    cache = OutputCache(memory_size=0, directory=str(tmp_path),
+                        disk_size=3 * size)
+    cache.set('{:064x}'.format(1), PNG)
+    for _ in range(20):
+        cache.set('{:064x}'.format(2), PNG)
+
+    assert '{:064x}'.format(1) in cache
+    assert cache._disk_used == sum(disk_files(str(tmp_path)).values())
@@ -0,0 +1,148 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from msc_pygeoapi.process.weather import jobs  # noqa
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+
+
+def wait(manager, job_id, timeout=5):
+    """return : status : status of the job once it is finished"""
+
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        status = manager.status(job_id)
+        if status['status'] in (jobs.SUCCESSFUL, jobs.FAILED):
+            return status
+        time.sleep(0.01)
+    raise AssertionError('job {} not finished'.format(job_id))
+
+
+@pytest.fixture(params=['memory', 'directory'])
+def manager(request, tmp_path):
+    directory = None
+    if request.param == 'directory':
+        directory = str(tmp_path / 'jobs')
+    manager = jobs.JobManager(workers=2, directory=directory, ttl=60,
+                              max_pending=2)
+    yield manager
+    manager._executor.shutdown(wait=True)
+
+
+@pytest.mark.parametrize('output', [PNG, {'png': PNG, 'bbox': [1, 2]},
+                                    {'type': 'Feature'}])
+def test_job_result_round_trip(manager, output):
+    job_id = manager.submit(lambda: output)['id']
+    assert wait(manager, job_id)['status'] == jobs.SUCCESSFUL
+    assert manager.result(job_id) == output
+
+
+def test_job_result_shared_by_directory(tmp_path):
+    directory = str(tmp_path / 'jobs')
+    manager = jobs.JobManager(workers=1, directory=directory)
+    job_id = manager.submit(lambda: {'png': PNG})['id']
+    wait(manager, job_id)
+
+    # another worker process sharing the directory
+    other = jobs.JobManager(workers=1, directory=directory)
+    assert other.status(job_id)['status'] == jobs.SUCCESSFUL
+    assert other.result(job_id) == {'png': PNG}
+
+
+def test_job_failure(manager):
+    def fail():
+        raise ValueError('no data')
+
+    status = wait(manager, manager.submit(fail)['id'])
+    assert status['status'] == jobs.FAILED
+    assert status['message'] == 'no data'
+
+
+def test_job_queue_full(manager):
+    release = threading.Event()
+    for _ in range(2):
+        manager.submit(release.wait)
+    with pytest.raises(jobs.JobQueueFull):
+        manager.submit(release.wait)
+    release.set()
+
+
+@pytest.mark.parametrize('job_id', ['../other/evil', '/etc/passwd',
+                                    'A' * 32, 'a' * 31, 'a' * 33, '',
+                                    None, 12])
+def test_invalid_job_id(manager, job_id):
+    with pytest.raises(ValueError):
+        manager.status(job_id)
+    with pytest.raises(ValueError):
+        manager.result(job_id)
+
+
+def test_job_file_outside_directory(tmp_path):
+    directory = tmp_path / 'jobs'
+    (tmp_path / 'other').mkdir()
+    (tmp_path / 'other' / 'evil.out').write_bytes(b'secret')
+    manager = jobs.JobManager(workers=1, directory=str(directory))
+    with pytest.raises(ValueError):
+        manager.result('../other/evil')
+
+
+def test_job_file_missing_keys(tmp_path):
+    directory = tmp_path / 'jobs'
+    manager = jobs.JobManager(workers=1, directory=str(directory))
+    job_id = 'a' * 32
+    with open(os.path.join(str(directory), job_id + '.json'), 'w') as fh:
+        json.dump({'id': job_id, 'status': jobs.SUCCESSFUL}, fh)
+
+    assert manager.status(job_id) is None
+    assert manager.result(job_id) is None
+
+
+def test_job_expired(tmp_path):
+    manager = jobs.JobManager(workers=1, directory=str(tmp_path), ttl=0)
+    job_id = manager.submit(lambda: PNG)['id']
+    end = time.monotonic() + 5
+    while manager.status(job_id) is not None and time.monotonic() < end:
+        time.sleep(0.01)
+    assert manager.status(job_id) is None
+
+
+def test_run_job_modes():
+    assert jobs.run_job(None, lambda x: x * 2, 2) == 4
+    assert jobs.run_job('sync', lambda x: x * 2, 2) == 4
+    with pytest.raises(ValueError):
+        jobs.run_job('later', lambda: None)
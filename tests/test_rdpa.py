@@ -0,0 +1,176 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from datetime import datetime, timedelta
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from msc_pygeoapi.process.weather import rdpa_graph as rg  # noqa
+
+LAYER = 'RDPA.6F_PR'
+# points spread over Canada (sparse pixel reads)
+XS = np.linspace(-130, -60, 20)
+YS = np.linspace(45, 70, 20)
+
+
+def add_docs(es, hours, begin=datetime(2020, 6, 1)):
+    """add 6h documents, every 6 hours from begin"""
+
+    dates = [(begin + timedelta(hours=6 * index)).strftime(rg.DATE_FORMAT)
+             for index in range(hours // 6)]
+    for index, date in enumerate(dates):
+        es.add({'layer': LAYER, 'filepath': '/rdpa/06/{}.grib2'.format(index),
+                'forecast_hour_datetime': date})
+    return dates
+
+
+def test_query_es_time_filter(fake_es):
+    dates = add_docs(fake_es, 10 * 24)
+    docs = list(rg.query_es(fake_es, rg.ES_INDEX, '2020-06-08T12:00:00Z',
+                            '2020-06-02T12:00:00Z', LAYER, '12:00:00Z'))
+    found = [doc['_source']['properties']['forecast_hour_datetime']
+             for doc in docs]
+    assert found == [date for date in dates
+                     if date.endswith('T12:00:00Z') and
+                     '2020-06-02T12' <= date <= '2020-06-08T13']
+
+    # the time filter is a terms filter on the indexed date, no script
+    query = rg.es_query('2020-06-08T12:00:00Z', '2020-06-02T12:00:00Z',
+                        LAYER, '12:00:00Z')
+    assert all('script' not in clause for clause in query['bool']['filter'])
+
+
+def test_query_es_pages(fake_es, monkeypatch):
+    from msc_pygeoapi.process.weather import util
+
+    monkeypatch.setattr(util, 'ES_PAGE_SIZE', 7)
+    dates = add_docs(fake_es, 30 * 24)
+    docs = list(rg.query_es(fake_es, rg.ES_INDEX, dates[-1], dates[0],
+                            LAYER))
+    assert [doc['_source']['properties']['forecast_hour_datetime']
+            for doc in docs] == dates
+
+
+def test_query_es_last(fake_es):
+    dates = add_docs(fake_es, 5 * 24)
+    last, total = rg.query_es_last(fake_es, rg.ES_INDEX, dates[10],
+                                   dates[2], LAYER)
+    assert last['forecast_hour_datetime'] == dates[10]
+    assert total == 9
+    assert rg.query_es_last(fake_es, rg.ES_INDEX, '2019-01-02T00:00:00Z',
+                            '2019-01-01T00:00:00Z', LAYER) == (None, 0)
+
+
+def test_graph_arrays():
+    dates = ['2020-06-0{}T12:00:00Z'.format(day) for day in range(1, 8)]
+    values = np.arange(14, dtype=np.float32).reshape(7, 2)
+
+    step_values, total_values, edges = rg.graph_arrays(values, dates, 48)
+    np.testing.assert_array_equal(step_values, [[2, 4], [10, 12],
+                                                [18, 20], [12, 13]])
+    np.testing.assert_array_equal(total_values[-1], values.sum(axis=0))
+    assert rg.format_dates(edges, 48) == ['2020-06-01', '2020-06-03',
+                                          '2020-06-05', '2020-06-07']
+
+    # a time step of 0 is the total of the period
+    step_values, total_values, edges = rg.graph_arrays(values, dates, 0)
+    np.testing.assert_array_equal(step_values, [values.sum(axis=0)])
+
+
+def test_graph_arrays_missing_dates():
+    dates = ['2020-06-01T12:00:00Z', '2020-06-02T12:00:00Z',
+             '2020-06-06T12:00:00Z']
+    step_values, _, edges = rg.graph_arrays([1, 2, 3], dates, 48)
+    # the empty time steps are dropped
+    assert step_values.tolist() == [3, 3]
+    assert rg.format_dates(edges, 48) == ['2020-06-01', '2020-06-05']
+
+
+def rdpa_values(weather, days):
+    date_end = weather['date_end']
+    date_begin = date_end - timedelta(days=days - 1)
+    source = rg.get_rpda_source(weather['layer'],
+                                date_end.strftime(rg.DATE_FORMAT),
+                                date_begin.strftime(rg.DATE_FORMAT), 24)
+    return source, rg.read_rpda_values(source, XS, YS)
+
+
+@pytest.mark.parametrize('days', [1, 7, 30])
+def test_cube_matches_files(weather, request, days):
+    source, files = rdpa_values(weather, days)
+    assert 'cube' not in source
+
+    request.getfixturevalue('weather_cube')
+    source, cube = rdpa_values(weather, days)
+    assert 'cube' in source
+
+    assert cube['dates'] == files['dates']
+    assert len(files['dates']) == days
+    np.testing.assert_array_equal(cube['values'], files['values'])
+
+
+def test_read_pixels_sparse_matches_window(weather, monkeypatch):
+    path = weather['rdpa_files'][-1][1]
+    cols, rows = rg.xy_2_pixel(rg.DATASETS.info(path).geotransform,
+                               *rg.transform_coord(path, XS, YS))
+
+    monkeypatch.setattr(rg, 'SPARSE_READ_FACTOR', 10 ** 9)
+    window = rg.read_pixels(path, cols, rows)
+    monkeypatch.setattr(rg, 'SPARSE_READ_FACTOR', 0)
+    sparse = rg.read_pixels(path, cols, rows)
+
+    np.testing.assert_array_equal(window, sparse)
+    assert window.any()
+
+
+def test_rdpa_output_cached_on_source(weather):
+    es = weather['es']
+    args = (weather['layer'], weather['date_end'].strftime(rg.DATE_FORMAT),
+            (weather['date_end'] - timedelta(days=6)).strftime(
+                rg.DATE_FORMAT), -75.7, 45.4, 24, 'GeoJSON')
+
+    first = rg.get_rpda_info(*args)
+    assert len(first['properties']['values']) == 7
+
+    # a hit only looks up the last document, no page is listed
+    searches = es.searches
+    assert rg.get_rpda_info(*args) == first
+    assert es.searches == searches + 1
+
+    # a reprocessed last file changes the key
+    path = weather['rdpa_files'][-1][1]
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    searches = es.searches
+    assert rg.get_rpda_info(*args) == first
+    assert es.searches > searches + 1
@@ -0,0 +1,222 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+
+from msc_pygeoapi.process.weather import generate_vigilance as gv  # noqa
+from msc_pygeoapi.process.weather.util import DatasetInfo  # noqa
+
+# GEPS global 0.5 degree grid
+GEOTRANSFORM = (-180.25, 0.5, 0, 90.25, 0, -0.5)
+
+
+def mask_levels(array1, array2, array3):
+    """vigilance levels computed with the original mask logic"""
+
+    array1 = array1.copy()
+    array1[array1 < 40] = 0
+    array1[(array1 >= 40) & (array1 < 60)] = 1
+    array1[array1 >= 60] = 1
+
+    array2 = array2.copy()
+    array2[(array2 >= 1) & (array2 < 20)] = 1
+    array2[(array2 >= 20) & (array2 < 40)] = 1
+    array2[(array2 >= 40) & (array2 < 60)] = 2
+    array2[array2 >= 60] = 2
+
+    array3 = array3.copy()
+    array3[(array3 >= 1) & (array3 < 20)] = 1
+    array3[(array3 >= 20) & (array3 < 40)] = 2
+    array3[(array3 >= 40) & (array3 < 60)] = 2
+    array3[array3 >= 60] = 3
+
+    return np.maximum(np.maximum(array1, array2), array3)
+
+
+def test_classify_matches_mask_logic():
+    rng = np.random.default_rng(0)
+    arrays = [rng.integers(0, 101, (64, 80)).astype(np.float32)
+              for _ in range(3)]
+    # the threshold values themselves
+    for array in arrays:
+        array[0, :8] = [0, 1, 19, 20, 39, 40, 59, 60]
+
+    out = np.zeros(arrays[0].shape, dtype=np.uint8)
+    for array, thresholds in zip(arrays, gv.VIGILANCE_THRESHOLDS):
+        gv.classify(array, thresholds, out)
+
+    np.testing.assert_array_equal(out, mask_levels(*arrays))
+
+
+def test_get_tiles_cover_window():
+    window = (13, 7, 300, 170)
+    tiles = gv.get_tiles(window, (64, 16), 100)
+    covered = np.zeros((window[3], window[2]), dtype=int)
+    for col, row, ncols, nrows in tiles:
+        assert col % 64 == 0 or col == window[0]
+        assert row % 16 == 0 or row == window[1]
+        covered[row - window[1]:row - window[1] + nrows,
+                col - window[0]:col - window[0] + ncols] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize('bbox', [[-140, 35, -44, 83], [-80.3, 44.1, -64.2,
+                                                        51.9]])
+def test_snap_bbox(bbox):
+    snapped = gv.snap_bbox(GEOTRANSFORM, list(bbox))
+    assert gv.bbox_window(GEOTRANSFORM, snapped) == \
+        gv.bbox_window(GEOTRANSFORM, bbox)
+    assert gv.snap_bbox(GEOTRANSFORM, snapped) == snapped
+
+
+def test_vigilance_statistics():
+    data = np.random.default_rng(1).integers(0, 4, (50, 70)).astype(
+        np.uint8)
+    data[0, 0] = 3
+    minimum, maximum, mean, std = gv.vigilance_statistics(data)
+    assert (minimum, maximum) == (data.min(), data.max())
+    assert mean == pytest.approx(data.mean())
+    assert std == pytest.approx(data.std())
+
+
+@pytest.mark.parametrize('tile, expected', [
+    ('0/0/0', (0, 0, 0)),
+    ('3/7/2', (3, 7, 2)),
+    ('3/8/2', None),
+    ('-1/0/0', None),
+    ('3/2', None),
+    ('a/b/c', None),
+    (None, None)
+])
+def test_parse_tile(tile, expected):
+    assert gv.parse_tile(tile) == expected
+
+
+def test_tile_bounds():
+    extent = gv.MERCATOR_EXTENT
+    assert gv.tile_bounds(0, 0, 0) == pytest.approx((-extent, -extent,
+                                                     extent, extent))
+    # the 4 tiles of zoom 1 split the world in quarters
+    assert gv.tile_bounds(1, 1, 0) == pytest.approx((0, 0, extent, extent))
+    assert gv.tile_bounds(1, 0, 1) == pytest.approx((-extent, -extent,
+                                                     0, 0))
+
+
+def test_mercator_to_lonlat():
+    lon, lat = gv.mercator_to_lonlat([-gv.MERCATOR_EXTENT, 0,
+                                      gv.MERCATOR_EXTENT],
+                                     [-gv.MERCATOR_EXTENT, 0,
+                                      gv.MERCATOR_EXTENT])
+    np.testing.assert_allclose(lon, [-180, 0, 180])
+    np.testing.assert_allclose(lat, [-85.0511287798, 0, 85.0511287798])
+
+
+def test_tile_bbox():
+    info = DatasetInfo(GEOTRANSFORM, '', 720, 361)
+    bbox = gv.tile_bbox(info, gv.tile_bounds(3, 2, 2))
+    west, south, east, north = bbox
+    assert (west, east) == pytest.approx((-90, -45))
+    assert south < north
+
+    # a tile outside of the raster
+    info = DatasetInfo((0.25, 0.5, 0, 50.25, 0, -0.5), '', 10, 10)
+    assert gv.tile_bbox(info, gv.tile_bounds(3, 0, 0)) is None
+
+
+def test_resample_tile_nearest():
+    rng = np.random.default_rng(2)
+    data = rng.integers(0, 4, (120, 200)).astype(np.uint8)
+    geotransform = (-100.0, 0.25, 0, 60.0, 0, -0.25)
+    bounds = gv.tile_bounds(4, 3, 5)
+    size = 32
+
+    tile = gv.resample_tile(data, geotransform, bounds, size)
+
+    step = (bounds[2] - bounds[0]) / size
+    for i in range(size):
+        for j in range(size):
+            lon, lat = gv.mercator_to_lonlat(bounds[0] + (j + 0.5) * step,
+                                             bounds[3] - (i + 0.5) * step)
+            col = int(np.floor((lon - geotransform[0]) / geotransform[1]))
+            row = int(np.floor((lat - geotransform[3]) / geotransform[5]))
+            expected = 0
+            if 0 <= col < data.shape[1] and 0 <= row < data.shape[0]:
+                expected = data[row, col]
+            assert tile[i, j] == expected
+
+
+def test_forecast_hours():
+    fh = datetime(2020, 6, 1)
+    fhs = gv.forecast_hours(fh, datetime(2020, 6, 3), 24)
+    assert fhs == [datetime(2020, 6, 1), datetime(2020, 6, 2),
+                   datetime(2020, 6, 3)]
+    assert gv.forecast_hours(fh, datetime(2020, 5, 31), 24) is None
+    assert gv.forecast_hours(fh, fh, 0) is None
+    assert gv.forecast_hours(fh, datetime(2021, 6, 1), 1) is None
+
+
+@pytest.mark.parametrize('bbox', ['-140, 35, -44, 83', '-80, 44, -64, 52'])
+def test_get_new_array_tiled(weather, monkeypatch, bbox):
+    files, _ = gv.get_files(weather['layers'], weather['fh'], weather['mr'])
+    path, bands = gv.get_bands(files)
+    bands.sort()
+    bbox = gv.convert_bbox(bbox.split(','))
+
+    whole = gv.get_new_array(path, bands, bbox, workers=1)
+    monkeypatch.setattr(gv, 'VIGILANCE_TILE_SIZE', 32)
+    tiled = gv.get_new_array(path, bands, bbox, workers=4)
+    np.testing.assert_array_equal(whole, tiled)
+
+    # the levels of the original reads and masks
+    window = gv.bbox_window(GEOTRANSFORM, bbox)
+    from osgeo import gdal
+    ds = gdal.Open(path)
+    arrays = [ds.GetRasterBand(band).ReadAsArray(*window).astype(np.float32)
+              for band in bands]
+    # the masks keep the values under 1 of the last 2 bands as they are
+    np.testing.assert_array_equal(whole,
+                                  mask_levels(*arrays).astype(np.uint8))
+
+
+def test_get_tile_cached_on_file_identity(weather, monkeypatch):
+    tile = '3/2/2'
+    first = gv.get_tile(weather['layers'], weather['fh'], weather['mr'],
+                        tile).getvalue()
+
+    reads = []
+    monkeypatch.setattr(gv, 'get_new_array',
+                        lambda *args: reads.append(args))
+    assert gv.get_tile(weather['layers'], weather['fh'], weather['mr'],
+                       tile).getvalue() == first
+    assert not reads
@@ -0,0 +1,497 @@
+# =================================================================
+#
+# Author: Julien Roy-Sabourin <julien.roy-sabourin.eccc@gccollaboration.ca>
+#
+# Copyright (c) 2020 Julien Roy-Sabourin
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+# =================================================================
+
+import base64
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+import json
+import logging
+import os
+import threading
+import time
+
+from elasticsearch import Elasticsearch, exceptions
+from osgeo import gdal
+
+from msc_pygeoapi.process.weather.metrics import count, FILES_OPENED
+
+LOGGER = logging.getLogger(__name__)
+
+# comma separated list of ES hosts
+ES_URL = os.environ.get('MSC_PYGEOAPI_ES_URL', 'localhost:9200')
+ES_TIMEOUT = float(os.environ.get('MSC_PYGEOAPI_ES_TIMEOUT', 30))
+# keep-alive connections kept per ES host
+ES_MAXSIZE = int(os.environ.get('MSC_PYGEOAPI_ES_MAXSIZE', 25))
+# hits fetched per page when streaming search results
+ES_PAGE_SIZE = int(os.environ.get('MSC_PYGEOAPI_ES_PAGE_SIZE', 500))
+
+# open GDAL dataset handles kept between requests
+DATASET_CACHE_SIZE = int(os.environ.get('MSC_PYGEOAPI_DATASET_CACHE_SIZE',
+                                        32))
+# files whose mtime and georeferencing are kept between requests
+DATASET_INFO_CACHE_SIZE = int(os.environ.get(
+    'MSC_PYGEOAPI_DATASET_INFO_CACHE_SIZE', 1024))
+
+_ES = None
+_ES_LOCK = threading.Lock()
+
+
+def get_es():
+    """
+    return the process-wide ES client, it is created on first use
+
+    the client keeps a pool of keep-alive connections per host and is
+    thread safe, so it is shared by all the weather processes and
+    pygeoapi worker threads
+
+    return : es : Elasticsearch client
+    """
+
+    global _ES
+
+    if _ES is None:
+        with _ES_LOCK:
+            if _ES is None:
+                hosts = [host.strip() for host in ES_URL.split(',')
+                         if host.strip()]
+                LOGGER.debug('Connecting to ES: {}'.format(hosts))
+                _ES = Elasticsearch(hosts, timeout=ES_TIMEOUT,
+                                    maxsize=ES_MAXSIZE,
+                                    retry_on_timeout=True)
+    return _ES
+
+
+def set_es(es):
+    """
+    replace the process-wide ES client (ex: by an in-process stand-in
+    for benchmarks)
+
+    param es : ES client, None to connect again on next use
+
+    return : es : previous ES client
+    """
+
+    global _ES
+
+    with _ES_LOCK:
+        previous, _ES = _ES, es
+    return previous
+
+
+def search_pages(es, index, body, page_size=None, keep_alive='1m'):
+    """
+    stream the hits of a sorted search page by page, using search_after
+    on a point in time, the number of hits is not limited by the ES
+    result window and only one page is held at a time
+
+    the first page is requested on the first iteration, ES errors are
+    raised while iterating
+
+    param es : ES client
+    param index : index name
+    param body : search body, it needs a 'sort'
+    param page_size : number of hits per page (default ES_PAGE_SIZE)
+    param keep_alive : how long ES keeps the point in time between pages
+
+    return : generator of the hits, in sort order
+    """
+
+    body = dict(body, size=page_size or ES_PAGE_SIZE,
+                track_total_hits=False)
+    pit = es.open_point_in_time(index=index, keep_alive=keep_alive)['id']
+
+    try:
+        while True:
+            body['pit'] = {'id': pit, 'keep_alive': keep_alive}
+            res = es.search(body=body)
+            pit = res.get('pit_id', pit)
+
+            hits = res['hits']['hits']
+            for hit in hits:
+                yield hit
+
+            if len(hits) < body['size']:
+                break
+            body['search_after'] = hits[-1]['sort']
+
+    finally:
+        try:
+            es.close_point_in_time(body={'id': pit})
+        except exceptions.ElasticsearchException as error:
+            LOGGER.warning('Cannot close ES point in time: {}'.format(error))
+
+
+class LRUCache(object):
+    """thread safe LRU cache with an optional time to live"""
+
+    def __init__(self, maxsize=128, ttl=None):
+        """
+        Initialize object
+
+        param maxsize : maximum number of entries kept
+        param ttl : default time to live of the entries in seconds
+                    (None to keep entries until evicted)
+        """
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        return the value cached for key and mark it as recently used
+
+        param key : key of the entry
+        param default : value returned if key is missing or expired
+
+        return : value : cached value
+        """
+
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        cache a value, evicting the least recently used entries
+
+        param key : key of the entry
+        param value : value to cache
+        param ttl : time to live in seconds (default is the cache ttl)
+        """
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        remove an entry from the cache
+
+        param key : key of the entry
+        param default : value returned if key is missing
+
+        return : value : removed value
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """remove every entry of the cache"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+DatasetInfo = namedtuple('DatasetInfo', ['geotransform', 'projection',
+                                         'xsize', 'ysize'])
+
+
+def file_mtime(path):
+    """
+    return the modification time of a file (local or GDAL virtual path)
+
+    param path : file path
+
+    return : mtime : modification time, None if the file is not found
+    """
+
+    stat = gdal.VSIStatL(path)
+    return None if stat is None else stat.mtime
+
+
+def get_mimetype(content):
+    """
+    find the mimetype of process output bytes
+
+    param content : output bytes
+
+    return : mimetype : mimetype of the content
+    """
+
+    if content.startswith(b'\x89PNG'):
+        return 'image/png'
+    elif content[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'image/tiff'
+    elif content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+
+def encode_output(output):
+    """
+    serialize a process output without pickle, so stored outputs can't
+    run code when they are read back
+
+    param output : bytes, BytesIO, or JSON dict (its bytes values are
+                   base64 encoded, ex: the GeoPNG png)
+
+    return : content, header : output bytes and JSON-able description
+                               of the content (type and mimetype)
+    """
+
+    if isinstance(output, (bytes, bytearray)):
+        content = bytes(output)
+        return content, {'type': 'bytes', 'mimetype': get_mimetype(content)}
+
+    if isinstance(output, BytesIO):
+        content = output.getvalue()
+        return content, {'type': 'buffer', 'mimetype': get_mimetype(content)}
+
+    if isinstance(output, dict):
+        binary = [key for key, value in output.items()
+                  if isinstance(value, (bytes, bytearray))]
+        output = dict(output)
+        for key in binary:
+            output[key] = base64.b64encode(output[key]).decode('ascii')
+        content = json.dumps(output).encode('utf-8')
+        return content, {'type': 'json', 'binary': binary,
+                         'mimetype': 'application/json'}
+
+    raise TypeError('unsupported output type: {}'.format(type(output)))
+
+
+def decode_output(content, header):
+    """
+    rebuild a process output serialized by encode_output
+
+    param content : output bytes
+    param header : description of the content
+
+    return : output : process output
+    """
+
+    if header['type'] == 'bytes':
+        return content
+    elif header['type'] == 'buffer':
+        return BytesIO(content)
+
+    output = json.loads(content.decode('utf-8'))
+    for key in header.get('binary', []):
+        output[key] = base64.b64decode(output[key])
+    return output
+
+
+def file_identity(path):
+    """
+    return the identity of a file version, used in cache keys
+
+    param path : file path (local or GDAL virtual path)
+
+    return : identity : path, modification time and size of the file,
+                        None if the file is not found
+    """
+
+    stat = gdal.VSIStatL(path)
+    return None if stat is None else (path, stat.mtime, stat.size)
+
+
+class DatasetCache(object):
+    """
+    thread safe LRU cache of open GDAL datasets
+
+    a dataset handle can't be used by two threads at the same time, so
+    handles are checked out with open() and given back to the cache
+    after use, handles of a file modified since it was opened are dropped;
+    the mtimes and georeferencing of the files are kept in LRU order too,
+    so a long running server doesn't keep one entry per archive file
+
+    the lock is only held to update the entries, files are stat'ed and
+    handles opened or closed without it
+    """
+
+    def __init__(self, maxsize=32, info_size=DATASET_INFO_CACHE_SIZE):
+        """
+        Initialize object
+
+        param maxsize : maximum number of idle handles kept open
+        param info_size : maximum number of files whose mtime and
+                          georeferencing are kept
+        """
+
+        self.maxsize = maxsize
+        self.info_size = max(info_size, 1)
+        self._handles = OrderedDict()     # (path, mtime): [idle handles]
+        self._infos = OrderedDict()       # path: (mtime, DatasetInfo)
+        self._mtimes = OrderedDict()      # path: last mtime seen
+        self._lock = threading.Lock()
+
+    def _remember(self, entries, path, value):
+        """
+        keep a per file entry, evicting the least recently used ones
+        (the lock must be held)
+
+        param entries : OrderedDict of the entries
+        param path : file path
+        param value : entry
+        """
+
+        entries[path] = value
+        entries.move_to_end(path)
+        while len(entries) > self.info_size:
+            entries.popitem(last=False)
+
+    def _check_mtime(self, path, mtime):
+        """
+        keep the mtime of a file and drop the entries of older versions
+        (the lock must be held)
+
+        param path : file path
+        param mtime : modification time of the file
+
+        return : handles : dropped handles, to close once the lock is
+                 released
+        """
+
+        handles = []
+        if self._mtimes.get(path, mtime) != mtime:
+            handles = self._handles.pop((path, self._mtimes[path]), [])
+            self._infos.pop(path, None)
+        self._remember(self._mtimes, path, mtime)
+        return handles
+
+    @contextmanager
+    def open(self, path):
+        """
+        check out an open dataset, it is given back to the cache on exit
+
+        param path : file path
+
+        return : ds : GDAL dataset (raise RuntimeError if it can't be
+                 opened)
+        """
+
+        ds = None
+        key = (path, file_mtime(path))
+        with self._lock:
+            stale = self._check_mtime(*key)
+            handles = self._handles.get(key)
+            if handles:
+                ds = handles.pop()
+                self._handles.move_to_end(key)
+        del stale
+
+        if ds is None:
+            ds = gdal.Open(path)
+            if ds is None:
+                raise RuntimeError(gdal.GetLastErrorMsg())
+            count(FILES_OPENED)
+
+        try:
+            yield ds
+        finally:
+            evicted = [ds]
+            with self._lock:
+                if self._mtimes.get(path) == key[1]:
+                    self._handles.setdefault(key, []).append(ds)
+                    self._handles.move_to_end(key)
+                    evicted = self._evict()
+            # the datasets are closed when their last reference is dropped
+            del evicted, ds
+
+    def _evict(self):
+        """
+        remove the least recently used handles above maxsize
+        (the lock must be held)
+
+        return : handles : removed handles, to close once the lock is
+                 released
+        """
+
+        evicted = []
+        total = sum(len(handles) for handles in self._handles.values())
+        while total > self.maxsize:
+            key, handles = next(iter(self._handles.items()))
+            evicted.append(handles.pop(0))
+            total -= 1
+            if not handles:
+                del self._handles[key]
+        return evicted
+
+    def info(self, path):
+        """
+        return the georeferencing of a dataset, kept until the file
+        is modified
+
+        param path : file path
+
+        return : info : DatasetInfo (geotransform, projection, xsize,
+                 ysize)
+        """
+
+        mtime = file_mtime(path)
+        with self._lock:
+            stale = self._check_mtime(path, mtime)
+            cached = self._infos.get(path)
+            if cached is not None and cached[0] == mtime:
+                self._infos.move_to_end(path)
+                return cached[1]
+        del stale
+
+        with self.open(path) as ds:
+            info = DatasetInfo(ds.GetGeoTransform(), ds.GetProjection(),
+                               ds.RasterXSize, ds.RasterYSize)
+
+        with self._lock:
+            self._remember(self._infos, path, (mtime, info))
+        return info
+
+    def clear(self):
+        """close every idle handle and forget the metadata"""
+
+        with self._lock:
+            handles, self._handles = self._handles, OrderedDict()
+            self._infos.clear()
+            self._mtimes.clear()
+        del handles
+
+
+# datasets shared by the weather processes
+DATASETS = DatasetCache(DATASET_CACHE_SIZE)